@@ -1,42 +1,238 @@
 #!/usr/bin/env python
-# Parse JSON order history from GOG.com with titles and prices and save it to .csv
+# Parse JSON order history from GOG.com with titles and prices and save it to .csv and optionally to SQLite store that
+# answers aggregate queries
 # AG @ 2021
 #
 # TODO: implement GOG login and download
 #
-import argparse
+import os
+import sys
+import csv
 import glob
 import json
+import sqlite3
+import decimal
+import argparse
 import datetime
+import concurrent.futures
+from decimal import Decimal
+
+STATE_VERSION = 1
+
+# Exact price from JSON amount like "9.99" or 9.99 (pages are loaded with numbers as Decimal), prices are whole cents
+def price(amount):
+    value = Decimal(amount)
+    if (value * 100) % 1:
+        raise ValueError(f'price {amount} has fractions of cents')
+    return value
+
+# Orders of one page file as (order ID, date, products) where products are (product ID, title, price paid, base price),
+# runs in worker process. Error is returned instead of raised, so one broken page doesn't stop the others
+def parsePage(filename):
+    try:
+        with open(filename, 'rb') as f:
+            gog = json.load(f, parse_float=Decimal) # numeric prices stay exact
+        orders = []
+        for order in gog['orders']:
+            orderDate = str(datetime.datetime.fromtimestamp(order['date']))
+            orders.append((order['publicId'], orderDate, [(str(product.get('id', product['title'])), product['title'],
+                                                           price(product['price']['amount']), price(product['price']['baseAmount']))
+                                                          for product in order['products']]))
+        return filename, orders, None
+    except (OSError, ValueError, KeyError, TypeError, decimal.InvalidOperation) as e:
+        return filename, None, e
+
+# Local store of orders in SQLite: orders keyed by order ID, products keyed by product ID and prices of products of every
+# order. Money is stored in integer cents, so sums are exact
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS orders (orderId TEXT PRIMARY KEY, date TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS products (productId TEXT PRIMARY KEY, title TEXT NOT NULL COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS orderProducts (orderId TEXT NOT NULL REFERENCES orders, productId TEXT NOT NULL REFERENCES products,
+                                          pricePaid INTEGER NOT NULL, priceBase INTEGER NOT NULL, PRIMARY KEY (orderId, productId));
+CREATE INDEX IF NOT EXISTS ordersDate ON orders (date);
+CREATE INDEX IF NOT EXISTS productsTitle ON products (title);
+CREATE INDEX IF NOT EXISTS orderProductsProduct ON orderProducts (productId);
+'''
+
+def openStore(dbFile):
+    store = sqlite3.connect(dbFile)
+    store.executescript(SCHEMA)
+    return store
+
+# Insert orders of page or update them if they are in store already
+def storeOrders(store, orders):
+    store.executemany('INSERT INTO orders VALUES (?, ?) ON CONFLICT (orderId) DO UPDATE SET date = excluded.date',
+                      [(orderId, orderDate) for orderId, orderDate, products in orders])
+    store.executemany('INSERT INTO products VALUES (?, ?) ON CONFLICT (productId) DO UPDATE SET title = excluded.title',
+                      [(productId, title) for orderId, orderDate, products in orders for productId, title, pricePaid, priceBase in products])
+    store.executemany('INSERT INTO orderProducts VALUES (?, ?, ?, ?) ON CONFLICT (orderId, productId) DO UPDATE SET ' +
+                      'pricePaid = excluded.pricePaid, priceBase = excluded.priceBase',
+                      [(orderId, productId, int(pricePaid * 100), int(priceBase * 100))
+                       for orderId, orderDate, products in orders for productId, title, pricePaid, priceBase in products])
+
+# State of incremental mode: size and modification time of every parsed page and IDs of orders already written to CSV
+def loadState(stateFile, outputFile, dbFile):
+    db = os.path.abspath(dbFile) if dbFile else None
+    try:
+        with open(stateFile, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('version') == STATE_VERSION and state.get('output') == os.path.abspath(outputFile) and os.path.exists(outputFile) and \
+           state.get('db') == db and (db is None or os.path.exists(db)):
+            return state
+    except (OSError, ValueError):
+        pass # missing or broken state, start over
+    return {'version': STATE_VERSION, 'output': os.path.abspath(outputFile), 'db': db, 'pages': {}, 'orders': []}
+
+def saveState(stateFile, state):
+    with open(stateFile + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(stateFile + '.tmp', stateFile)
 
-parser = argparse.ArgumentParser(description='<< Parse GOG.com orders history >> v1.0\n\n' +
-    'To use login to GOG first and download all JSONs of completed orders using URL with page numbers 1-N:\n'
-    '  https://www.gog.com/account/settings/orders/data?canceled=0&completed=1&in_progress=0&not_redeemed=0&pending=0&redeemed=0&page=1',
-    formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument('inputMask', help='mask of JSON input files, for example \'data*.json\'')
-parser.add_argument('outputFile', help='name of CSV output file, for example \'gogOrders.csv\'')
-args = parser.parse_args()
-
-with open(args.outputFile, "w", encoding="utf-8") as csvOut:
-    csvOut.write(f'Date, Title, PricePaid, PriceBase\n')
-    totalOrderCount, totalPricePaid, totalPriceBase = 0, 0, 0
+def pageVersion(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+# Parse pages in worker processes and write their orders in order of pages, orders already written are skipped. All
+# orders of parsed pages are upserted to store if it's given. Returns number of new orders, total paid and total base price
+# of their products
+def writeOrders(filenames, csvOut, writtenOrders, workers, store=None):
+    orderCount, totalPricePaid, totalPriceBase, parsedPages = 0, Decimal(0), Decimal(0), []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for filename, orders, error in pool.map(parsePage, filenames, chunksize=4):
+            if error is not None:
+                print(f'Error happened on {filename} - {str(error)}')
+                continue
+            newOrders = [order for order in orders if order[0] not in writtenOrders]
+            print(f'{filename} contains {len(orders)} orders, {len(newOrders)} new')
+            for orderId, orderDate, products in newOrders:
+                for productId, title, pricePaid, priceBase in products:
+                    totalPricePaid += pricePaid
+                    totalPriceBase += priceBase
+                    csvOut.writerow([orderDate, title, f'{pricePaid:f}', f'{priceBase:f}'])
+                writtenOrders.add(orderId)
+            if store is not None:
+                storeOrders(store, orders)
+            orderCount += len(newOrders)
+            parsedPages.append(filename)
+    return orderCount, totalPricePaid, totalPriceBase, parsedPages
+
+# Reports of store as column names and SQL that sums prices in cents over orders matching {where}, periods are taken
+# from ISO dates of orders
+ORDER_LINES = 'FROM orders o JOIN orderProducts op USING (orderId) JOIN products p USING (productId) {where}'
+REPORTS = {
+    'years': (['Year', 'Orders', 'Products', 'PricePaid', 'PriceBase', 'Discount'],
+              'SELECT substr(o.date, 1, 4) AS period, count(DISTINCT o.orderId), count(*), sum(op.pricePaid), sum(op.priceBase) ' +
+              ORDER_LINES + ' GROUP BY period ORDER BY period'),
+    'months': (['Month', 'Orders', 'Products', 'PricePaid', 'PriceBase', 'Discount'],
+               'SELECT substr(o.date, 1, 7) AS period, count(DISTINCT o.orderId), count(*), sum(op.pricePaid), sum(op.priceBase) ' +
+               ORDER_LINES + ' GROUP BY period ORDER BY period'),
+    'running': (['Month', 'PricePaid', 'PriceBase', 'TotalPaid', 'TotalBase', 'Discount'],
+                'SELECT substr(o.date, 1, 7) AS period, sum(op.pricePaid), sum(op.priceBase), sum(sum(op.pricePaid)) OVER (ORDER BY substr(o.date, 1, 7)), ' +
+                'sum(sum(op.priceBase)) OVER (ORDER BY substr(o.date, 1, 7)) ' + ORDER_LINES + ' GROUP BY period ORDER BY period'),
+    'discounts': (['Title', 'Bought', 'PricePaid', 'PriceBase', 'Saved', 'Discount'],
+                  'SELECT p.title, count(*), sum(op.pricePaid), sum(op.priceBase), sum(op.priceBase - op.pricePaid) AS saved ' +
+                  ORDER_LINES + ' GROUP BY op.productId ORDER BY saved DESC, p.title LIMIT :top'),
+    'duplicates': (['Title', 'Bought', 'PricePaid', 'FirstDate', 'LastDate'],
+                   'SELECT p.title, count(DISTINCT o.orderId) AS bought, sum(op.pricePaid), min(o.date), max(o.date) ' +
+                   ORDER_LINES + ' GROUP BY op.productId HAVING bought > 1 ORDER BY bought DESC, p.title LIMIT :top'),
+}
+MONEY_COLUMNS = {'PricePaid', 'PriceBase', 'TotalPaid', 'TotalBase', 'Saved'}
+
+# Rows of report as text, money in cents is shown exactly in dollars and discount is calculated from running totals or
+# prices of row
+def reportRows(columns, rows):
+    paidColumn, baseColumn = ('TotalPaid', 'TotalBase') if 'TotalPaid' in columns else ('PricePaid', 'PriceBase')
+    for row in rows:
+        values = [f'{Decimal(value).scaleb(-2):.2f}' if column in MONEY_COLUMNS else str(value) for column, value in zip(columns, row)]
+        if columns[-1] == 'Discount':
+            paid, base = row[columns.index(paidColumn)], row[columns.index(baseColumn)]
+            values.append(f'{(base - paid) * Decimal(100) / base:.1f}%' if base else '-')
+        yield values
+
+def printTable(columns, rows):
+    widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+    for row in [columns] + rows:
+        print('  '.join(value.ljust(width) if i == 0 else value.rjust(width) for i, (value, width) in enumerate(zip(row, widths))))
+
+# Aggregate queries over SQLite store filled by --db, parsed JSON pages aren't needed
+def query(arguments):
+    parser = argparse.ArgumentParser(prog=f'{os.path.basename(sys.argv[0])} query', description='Aggregate reports of GOG.com orders saved with --db',
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('dbFile', help='SQLite store of orders, for example \'gogOrders.db\'')
+    parser.add_argument('report', choices=REPORTS, help='years/months - totals per period, running - running totals per month,\n' +
+        'discounts - titles with most money saved, duplicates - titles bought in more than one order', metavar='{' + ','.join(REPORTS) + '}')
+    parser.add_argument('--since', metavar='DATE', help='only orders from this date, for example 2020-01-01')
+    parser.add_argument('--until', metavar='DATE', help='only orders before this date')
+    parser.add_argument('--title', metavar='PREFIX', help='only products with titles starting with PREFIX (case insensitive)')
+    parser.add_argument('--top', type=int, default=20, help='number of titles in discounts and duplicates (default: %(default)s)')
+    args = parser.parse_args(arguments)
+    if not os.path.exists(args.dbFile):
+        parser.error(f'{args.dbFile} doesn\'t exist, save orders to it with --db first')
+
+    procStart = datetime.datetime.now()
+    conditions, parameters = [], {'top': args.top}
+    if args.since:
+        conditions.append('o.date >= :since')
+        parameters['since'] = args.since
+    if args.until:
+        conditions.append('o.date < :until')
+        parameters['until'] = args.until
+    if args.title:
+        conditions.append("p.title LIKE :title ESCAPE '\\'")
+        parameters['title'] = args.title.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    columns, sql = REPORTS[args.report]
+    store = openStore(args.dbFile)
     try:
-        for filename in glob.glob(args.inputMask):
-            with open(filename, 'r') as f:
-                gog = json.loads(f.read())
-                orderCount = len(gog['orders'])
-                totalOrderCount += orderCount
-                print(f'{filename} contains {orderCount} orders, parsing ...')
-                for order in gog['orders']:
-                    orderDate = datetime.datetime.fromtimestamp(order['date'])
-                    for product in order['products']:
-                        title = product['title']
-                        pricePaid = product['price']['amount']
-                        priceBase = product['price']['baseAmount']
-                        totalPricePaid += float(pricePaid)
-                        totalPriceBase += float(priceBase)
-                        csvOut.write(f'"{orderDate}","{title}",{pricePaid},{priceBase}\n')
-    except Exception as e:
-        print(f'Error happened on {filename} - {str(e)}')
-    print(f'Total {totalOrderCount} orders, paid ${totalPricePaid:.2f} for products worth ${totalPriceBase:.2f}')
-    csvOut.close()
+        rows = store.execute(sql.format(where='WHERE ' + ' AND '.join(conditions) if conditions else ''), parameters).fetchall()
+    finally:
+        store.close()
+    printTable(columns, list(reportRows(columns, rows)))
+    print(f'{len(rows)} rows in {(datetime.datetime.now() - procStart).total_seconds():.3f} sec')
+
+def main():
+    if sys.argv[1:2] == ['query']:
+        query(sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(description='<< Parse GOG.com orders history >> v1.2\n\n' +
+        'To use login to GOG first and download all JSONs of completed orders using URL with page numbers 1-N:\n'
+        '  https://www.gog.com/account/settings/orders/data?canceled=0&completed=1&in_progress=0&not_redeemed=0&pending=0&redeemed=0&page=1\n\n' +
+        'Orders saved with --db can be queried without parsing pages again, see \'query -h\'',
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('inputMask', help='mask of JSON input files, for example \'data*.json\'')
+    parser.add_argument('outputFile', help='name of CSV output file, for example \'gogOrders.csv\'')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes parsing pages (default: number of CPUs)')
+    parser.add_argument('--state', metavar='STATEFILE', help='remember parsed pages and orders, next run parses only new or changed pages\n' +
+        'and appends only new orders to CSV output file')
+    parser.add_argument('--db', metavar='DBFILE', help='also insert or update orders in SQLite store for \'query\' reports')
+    args = parser.parse_args()
+
+    filenames = sorted(glob.glob(args.inputMask))
+    state = loadState(args.state, args.outputFile, args.db) if args.state else None
+    if state and state['pages']:
+        changed = [filename for filename in filenames if state['pages'].get(filename) != pageVersion(filename)]
+        print(f'{len(filenames) - len(changed)} pages unchanged since last run, parsing {len(changed)} new or changed pages ...')
+        filenames = changed
+    appending = bool(state and state['orders'])
+
+    writtenOrders = set(state['orders']) if state else set()
+    store = openStore(args.db) if args.db else None
+    try:
+        with open(args.outputFile, 'a' if appending else 'w', encoding='utf-8', newline='', buffering=1 << 20) as f:
+            csvOut = csv.writer(f)
+            if not appending:
+                csvOut.writerow(['Date', 'Title', 'PricePaid', 'PriceBase'])
+            totalOrderCount, totalPricePaid, totalPriceBase, parsedPages = writeOrders(filenames, csvOut, writtenOrders, args.workers, store)
+        if store is not None:
+            store.commit() # before state, so pages are never marked parsed without their orders in store
+    finally:
+        if store is not None:
+            store.close()
+    print(f'Total {totalOrderCount} {"new " if appending else ""}orders, paid ${totalPricePaid:.2f} for products worth ${totalPriceBase:.2f}')
+
+    if state is not None: # pages that failed are parsed again next time
+        state['pages'].update({filename: pageVersion(filename) for filename in parsedPages})
+        state['orders'] = sorted(writtenOrders, key=str)
+        saveState(args.state, state)
+
+if __name__ == '__main__':
+    main()
@@ -1,66 +1,405 @@
 # Least Frequently Used Cache
 # AG @ 2021
 
+import sys
+import time
+import random
+import argparse
+import functools
+import threading
 from collections import defaultdict
+from collections import namedtuple
 from collections import OrderedDict
 
-# Helper class to store value and frequency count
+MISSING = object() # sentinel returned by get() on a miss when no default is given, so None can be a cached value
+
+# Helper class to store value and frequency count, slots keep every entry small (no __dict__ per node)
 class Node:
-    def __init__(self, val: int, count: int):
+    __slots__ = ("val", "count")
+
+    def __init__(self, val, count: int):
         self.val = val
         self.count = count
 
-# Main class of LFU cache with fixed capacity
+# Main class of LFU cache with fixed capacity, keys are any hashable objects. Capacity None means unbounded cache
 class LFUCache:
-    def __init__(self, capacity: int):
+    def __init__(self, capacity):
         self.capacity = capacity
         self.keyToNode = {}                         # map: key -> value and count
         self.countToNode = defaultdict(OrderedDict) # map: frequency count -> ordered dictionary of nodes with this frequency
         self.lfuCount = None                        # frequency of least used nodes in cache
+        self.evictions = 0                          # number of keys evicted to make room for new ones
+
+    def __len__(self):
+        return len(self.keyToNode)
+
+    # membership test doesn't count as use of the key
+    def __contains__(self, key):
+        return key in self.keyToNode
+
+    # value of key or default (MISSING if not given) when key is not in cache
+    def get(self, key, default=MISSING):
+        node = self.keyToNode.get(key)
+        if node is None:
+            return default
+        self.increment(key, node)
+        return node.val
+
+    # move node to the next frequency, called on every get() and put() of existing key
+    def increment(self, key, node):
+        nodes = self.countToNode[node.count]
+        del nodes[key]
 
-    def get(self, key: int) -> int:
-        if key not in self.keyToNode:
-            return -1
-        
-        node = self.keyToNode[key]
-        del self.countToNode[node.count][key]
-        
-        # Free up memory if this frequency map is empty now
-        if not self.countToNode[node.count]:
+        # Free up memory if this frequency map is empty now, if it was the least used frequency adjust it
+        if not nodes:
             del self.countToNode[node.count]
-        
-        node.count += 1 # increment frequency count on every get()
+            if node.count == self.lfuCount:
+                self.lfuCount += 1
+
+        node.count += 1 # increment frequency count on every use
         self.countToNode[node.count][key] = node
-        
-        # If least used frequency is empty adjust it
-        if not self.countToNode[self.lfuCount]:
-            self.lfuCount += 1
-            
-        return node.val
 
-    def put(self, key: int, value: int) -> None:
-        if not self.capacity:
+    def put(self, key, value) -> None:
+        if self.capacity == 0:
             return
-        
-        if key in self.keyToNode:
-            self.keyToNode[key].val = value
-            self.get(key) # re-use getter code and adjust frequency of this key
+
+        node = self.keyToNode.get(key) # one lookup for both update and insert
+        if node is not None:
+            node.val = value
+            self.increment(key, node)
             return
-        
-        if len(self.keyToNode) >= self.capacity:
-            k,v = self.countToNode[self.lfuCount].popitem(last=False) # last=False will use FIFO order, so it will pop LRU key
-            del self.keyToNode[k]
-        
+
+        if self.capacity is not None and len(self.keyToNode) >= self.capacity:
+            self.evict()
+
         self.countToNode[1][key] = self.keyToNode[key] = Node(value, 1)
         self.lfuCount = 1 # the lowest frequency now is 1 since we have a new item
-        return
-
-cache = LFUCache(3)
-cache.put(2, 20)
-cache.put(3, 30)
-cache.put(1, 10)
-print(cache.get(2))
-print(cache.get(2))
-cache.put(4, 40)
-print(cache.get(1))
-print(cache.get(3))
\ No newline at end of file
+
+    # drop the least recently used key of the least used frequency
+    def evict(self):
+        nodes = self.countToNode[self.lfuCount]
+        k, v = nodes.popitem(last=False) # last=False will use FIFO order, so it will pop LRU key
+        if not nodes:
+            del self.countToNode[self.lfuCount]
+        del self.keyToNode[k]
+        self.evictions += 1
+
+    def clear(self):
+        self.keyToNode.clear()
+        self.countToNode.clear()
+        self.lfuCount = None
+
+HALVED = bytes(count >> 1 for count in range(256)) # translation table that halves every counter of sketch at once
+
+# Count-min sketch of approximate access frequencies, it keeps counting keys that are no longer in cache. Its memory is fixed
+# by capacity (depth rows of byte counters as wide as capacity rounded up to power of two), not by number of keys seen.
+# Counters saturate at 15 and all of them are halved after every sampleSize increments, so keys that went cold fade away
+class FrequencySketch:
+    def __init__(self, capacity: int, depth: int = 4):
+        width = 1 << max(4, (capacity - 1).bit_length())
+        self.mask = width - 1
+        self.rows = [bytearray(width) for i in range(depth)]
+        self.sampleSize, self.additions = 5 * width, 0 # counts halve before most counters of hot keys saturate
+
+    # counters of key are at index h, h + step, h + 2*step... of the rows (double hashing), step is hash scrambled by
+    # golden ratio multiplier
+    def increment(self, key) -> None:
+        h = hash(key)
+        step, mask = ((h & 0xFFFFFFFF) * 0x9E3779B1) >> 16 | 1, self.mask
+        for row in self.rows:
+            if row[h & mask] < 15:
+                row[h & mask] += 1
+            h += step
+        self.additions += 1
+        if self.additions >= self.sampleSize: # aging
+            self.rows = [row.translate(HALVED) for row in self.rows]
+            self.additions //= 2
+
+    def estimate(self, key) -> int:
+        h = hash(key)
+        step, mask, count = ((h & 0xFFFFFFFF) * 0x9E3779B1) >> 16 | 1, self.mask, 15
+        for row in self.rows:
+            if row[h & mask] < count:
+                count = row[h & mask]
+            h += step
+        return count
+
+    def clear(self):
+        self.rows = [bytearray(len(row)) for row in self.rows]
+        self.additions = 0
+
+# W-TinyLFU cache with the same interface as LFUCache: new keys enter small LRU admission window (windowPercent of capacity),
+# key leaving the window enters main region only if sketch estimates it was used more often than the key main region would
+# evict for it. Main region is segmented LRU: keys used again move from probation to protected segment (80% of main region),
+# the least recently used protected keys go back to probation. Unlike exact counts of LFUCache, frequencies in sketch age,
+# so keys that were hot long ago get evicted and new keys can stay. Every get() counts as use of the key and so does put()
+# unless it stores the key that get() just missed
+class WTinyLFUCache:
+    def __init__(self, capacity: int, windowPercent: int = 1):
+        if capacity is None:
+            raise ValueError("W-TinyLFU cache needs bounded capacity")
+        self.capacity = capacity
+        self.windowSize = max(1, capacity * windowPercent // 100) if capacity else 0
+        self.mainSize = capacity - self.windowSize
+        self.protectedSize = self.mainSize * 80 // 100
+        self.window, self.probation, self.protected = OrderedDict(), OrderedDict(), OrderedDict() # map: key -> value in LRU order
+        self.sketch = FrequencySketch(max(capacity, 1))
+        self.evictions = 0    # number of keys evicted or not admitted
+        self.missed = MISSING # key of the last get() that missed, its put() is the same use of the key
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def __contains__(self, key):
+        return key in self.window or key in self.probation or key in self.protected
+
+    def get(self, key, default=MISSING):
+        self.sketch.increment(key)
+        value = self.hit(key, MISSING)
+        if value is MISSING:
+            self.missed = key
+            return default
+        return value
+
+    # value of key moved to the most recent position of its segment, key used from probation is protected from now on
+    def hit(self, key, default):
+        for segment in (self.window, self.protected):
+            value = segment.get(key, MISSING)
+            if value is not MISSING:
+                segment.move_to_end(key)
+                return value
+        value = self.probation.pop(key, MISSING)
+        if value is MISSING:
+            return default
+        self.protected[key] = value
+        if len(self.protected) > self.protectedSize:
+            k, v = self.protected.popitem(last=False)
+            self.probation[k] = v
+        return value
+
+    def put(self, key, value) -> None:
+        if self.capacity == 0:
+            return
+        if key is not self.missed and key != self.missed:
+            self.sketch.increment(key)
+        self.missed = MISSING
+        for segment in (self.window, self.protected, self.probation):
+            if key in segment:
+                segment[key] = value
+                self.hit(key, None)
+                return
+
+        self.window[key] = value
+        if len(self.window) > self.windowSize:
+            self.admit(*self.window.popitem(last=False))
+
+    # candidate from window replaces the least recently used probation key only if it's more frequent
+    def admit(self, key, value):
+        if len(self.probation) + len(self.protected) < self.mainSize:
+            self.probation[key] = value
+            return
+        self.evictions += 1
+        if not self.probation: # no main region
+            return
+        victim = next(iter(self.probation))
+        if self.sketch.estimate(key) > self.sketch.estimate(victim):
+            del self.probation[victim]
+            self.probation[key] = value
+
+    def clear(self):
+        self.window.clear()
+        self.probation.clear()
+        self.protected.clear()
+        self.sketch.clear()
+
+# LFU cache for thread pools: keys are spread by hash over shards, every shard is LFUCache (or WTinyLFUCache) with its own
+# lock, so threads that use different shards don't wait for each other. Frequencies are counted per shard, so evicted key
+# is the least frequently used key of its shard rather than of the whole cache
+class ShardedLFUCache:
+    def __init__(self, capacity, shards: int = 16, tinylfu: bool = False):
+        cacheClass = WTinyLFUCache if tinylfu else LFUCache
+        if capacity is not None: # no more shards than capacity, shard of capacity 0 would never keep its keys
+            shards = max(1, min(shards, capacity))
+        if capacity is None:
+            self.shards = [cacheClass(None) for i in range(shards)]
+        else: # split capacity evenly, the first shards take the remainder
+            self.shards = [cacheClass(capacity // shards + (i < capacity % shards)) for i in range(shards)]
+        self.locks = [threading.Lock() for i in range(shards)]
+        self.capacity, self.count = capacity, shards
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __contains__(self, key):
+        return key in self.shards[hash(key) % self.count]
+
+    def get(self, key, default=MISSING):
+        i = hash(key) % self.count
+        with self.locks[i]:
+            return self.shards[i].get(key, default)
+
+    def put(self, key, value) -> None:
+        i = hash(key) % self.count
+        with self.locks[i]:
+            self.shards[i].put(key, value)
+
+    @property
+    def evictions(self):
+        return sum(shard.evictions for shard in self.shards)
+
+    def clear(self):
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                shard.clear()
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+KWARGS_MARK = object() # separates positional and keyword arguments in key of cached call
+
+# Key of function call, equal arguments give equal keys, single int or str argument is the key itself like in functools.lru_cache
+def callKey(args, kwargs):
+    if not kwargs:
+        return args[0] if len(args) == 1 and type(args[0]) in (int, str) else args
+    return args + (KWARGS_MARK,) + tuple(kwargs.items())
+
+# Decorator that memoizes function in LFU cache (W-TinyLFU with tinylfu) of maxsize results, the same way as functools.lru_cache
+# does with LRU: cache_info() returns hits, misses, evictions and size, cache_clear() empties cache. Arguments have to be
+# hashable. Function is called outside of the lock, so concurrent misses of the same key may call it more than once
+def lfu_cache(maxsize=128, tinylfu: bool = False):
+    if callable(maxsize): # used as @lfu_cache without arguments
+        return lfu_cache()(maxsize)
+
+    def decorator(function):
+        cache, lock = WTinyLFUCache(maxsize) if tinylfu else LFUCache(maxsize), threading.Lock()
+        stats = [0, 0] # hits, misses
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            key = callKey(args, kwargs)
+            with lock:
+                result = cache.get(key)
+                if result is not MISSING:
+                    stats[0] += 1
+                    return result
+                stats[1] += 1
+            result = function(*args, **kwargs)
+            with lock:
+                cache.put(key, result)
+            return result
+
+        def cache_info():
+            with lock:
+                return CacheInfo(stats[0], stats[1], cache.evictions, maxsize, len(cache))
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                stats[0] = stats[1] = cache.evictions = 0
+
+        wrapper.cache_info, wrapper.cache_clear = cache_info, cache_clear
+        return wrapper
+    return decorator
+
+# Keys of skewed workload: key k (counted from 1) is requested with probability proportional to 1/k^skew
+def zipfKeys(keys: int, requests: int, skew: float, seed: int = 2021):
+    rng = random.Random(seed)
+    weights = [1 / k ** skew for k in range(1, keys + 1)]
+    return rng.choices(range(keys), weights=weights, k=requests)
+
+# Hit rate and requests per second of memoized function with LFU and LRU caches of the same size on Zipf workload
+def benchmark(keys: int, requests: int, skews, sizes, threads: int):
+    print(f"{keys} keys, {requests} requests, hit rate and requests per second of memoized function\n")
+    print(f"{'skew':>5} {'size':>7}   {'lfu_cache':>22}   {'functools.lru_cache':>22}")
+    for skew in skews:
+        trace = zipfKeys(keys, requests, skew)
+        for size in sizes:
+            line = f"{skew:>5} {size:>7}"
+            for decorate in (lfu_cache(size), functools.lru_cache(size)):
+                cached = decorate(lambda key: key)
+                start = time.perf_counter()
+                for key in trace:
+                    cached(key)
+                elapsed = time.perf_counter() - start
+                info = cached.cache_info()
+                line += f"   {info.hits / requests:>6.1%} {requests / elapsed:>11,.0f} op/s"
+            print(line)
+
+    # the same trace from thread pool: one lock for whole cache against lock per shard
+    trace, size = zipfKeys(keys, requests, skews[0]), sizes[0]
+    print(f"\n{threads} threads, skew {skews[0]}, size {size}, get and put on miss")
+    for name, cache, locks in (("LFUCache with one lock", LFUCache(size), [threading.Lock()]),
+                               ("ShardedLFUCache", ShardedLFUCache(size), None)):
+        def worker(part):
+            lock = locks[0] if locks else None
+            for key in part:
+                if lock:
+                    with lock:
+                        if cache.get(key) is MISSING: cache.put(key, key)
+                elif cache.get(key) is MISSING:
+                    cache.put(key, key)
+        workers = [threading.Thread(target=worker, args=(trace[i::threads],)) for i in range(threads)]
+        start = time.perf_counter()
+        for thread in workers: thread.start()
+        for thread in workers: thread.join()
+        elapsed = time.perf_counter() - start
+        print(f"  {name:<24} {requests / elapsed:>11,.0f} op/s, {cache.evictions} evictions")
+
+# Trace of shifting traffic: keys of every phase are Zipf distributed, but every phase has its own random set of hot keys
+def shiftingTrace(keys: int, requests: int, skew: float, phases: int, seed: int = 2021):
+    rng, trace = random.Random(seed), []
+    for phase in range(phases):
+        hot = list(range(keys))
+        rng.shuffle(hot)
+        trace.extend(hot[rank] for rank in zipfKeys(keys, requests // phases, skew, seed + phase))
+    return trace
+
+# Hit rate and requests per second of plain LFU and W-TinyLFU caches replaying trace, every request is get and put on miss
+def replay(trace, sizes):
+    print(f"{len(trace)} requests, {len(set(trace))} distinct keys\n")
+    print(f"{'size':>7}   {'LFUCache':>22}   {'WTinyLFUCache':>22}")
+    for size in sizes:
+        line = f"{size:>7}"
+        for cache in (LFUCache(size), WTinyLFUCache(size)):
+            hits = 0
+            start = time.perf_counter()
+            for key in trace:
+                if cache.get(key) is MISSING:
+                    cache.put(key, key)
+                else:
+                    hits += 1
+            elapsed = time.perf_counter() - start
+            line += f"   {hits / len(trace):>6.1%} {len(trace) / elapsed:>11,.0f} op/s"
+        print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LFU cache demo and benchmark against functools.lru_cache on Zipf workload")
+    parser.add_argument("--benchmark", action="store_true", help="run benchmark instead of demo")
+    parser.add_argument("--replay", nargs="?", const="", metavar="TRACEFILE", help="replay trace file with one key per line (or generated trace of shifting traffic) in plain LFU and W-TinyLFU caches")
+    parser.add_argument("--phases", type=int, default=4, help="number of different hot sets in generated trace of shifting traffic (default: %(default)s)")
+    parser.add_argument("--keys", type=int, default=100000, help="number of distinct keys (default: %(default)s)")
+    parser.add_argument("--requests", type=int, default=1000000, help="number of requests (default: %(default)s)")
+    parser.add_argument("--skew", type=float, nargs="+", default=[0.8, 1.0, 1.2], help="Zipf exponents of workloads (default: %(default)s)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="cache sizes (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=4, help="threads of concurrent benchmark (default: %(default)s)")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.keys, args.requests, args.skew, args.sizes, args.threads)
+        sys.exit(0)
+    if args.replay is not None:
+        if args.replay:
+            with open(args.replay) as fileIn:
+                trace = [line.strip() for line in fileIn if line.strip()]
+        else:
+            trace = shiftingTrace(args.keys, args.requests, args.skew[0], args.phases)
+        replay(trace, args.sizes)
+        sys.exit(0)
+
+    cache = LFUCache(3)
+    cache.put(2, 20)
+    cache.put(3, 30)
+    cache.put(1, 10)
+    print(cache.get(2, -1))
+    print(cache.get(2, -1))
+    cache.put(4, 40)
+    print(cache.get(1, -1))
+    print(cache.get(3, -1))
@@ -0,0 +1,336 @@
+# Benchmarks of stockDigger on synthetic Stooq.com database: generator of the database, per-phase timings, metric
+# and pipeline benchmarks with JSON results to compare versions, memory of metric state
+# AG @ 2020
+import os
+import sys
+import gc
+import json
+import time
+import array
+import random
+import zipfile
+import shutil
+import pstats
+import cProfile
+import argparse
+import datetime
+import tempfile
+import platform
+import tracemalloc
+import stooqData
+import stockDigger
+
+END_DATE = datetime.date(2021, 6, 30)
+RESULTS_VERSION = 1
+EXCHANGES = ["nasdaq stocks/1", "nyse stocks/1", "nyse etfs"] # subfolders of data/daily/us like in Stooq.com database
+
+# Deterministic synthetic database: random walk prices of trading days (Monday to Friday) that end on endDate, every
+# ticker has between half and full history length, so some of them don't have enough history for metrics, and misses
+# every trading day with probability of gaps. The first tickers are SPY.US and FB.US that metrics look for
+def syntheticSeries(tickers, history, gaps=0.0, endDate=END_DATE, seed=2020):
+    rng = random.Random(seed)
+    tradingDays = array.array("i")
+    day = endDate
+    while len(tradingDays) < history:
+        if day.weekday() < 5: tradingDays.append(day.toordinal())
+        day -= datetime.timedelta(days=1)
+    tradingDays.reverse()
+    for number in range(tickers):
+        length = rng.randint(history // 2, history)
+        price, dates, closes = rng.uniform(1, 300), array.array("i"), array.array("d")
+        for ordinal in tradingDays[history - length:]:
+            if gaps and rng.random() < gaps: continue
+            price = max(0.01, price * (1 + rng.uniform(-0.03, 0.031)))
+            dates.append(ordinal)
+            closes.append(round(price, 4))
+        yield ["SPY.US", "FB.US"][number] if number < 2 else f"T{number:05d}.US", dates, closes
+
+# Write synthetic database in Stooq.com text format into folder/data/daily/us/<exchange>/<ticker>.txt
+def writeDatabase(folder, tickers, history, gaps=0.0, seed=2020):
+    rows = 0
+    for number, (ticker, dates, closes) in enumerate(syntheticSeries(tickers, history, gaps, seed=seed)):
+        subfolder = os.path.join(folder, "data", "daily", "us", EXCHANGES[number % len(EXCHANGES)])
+        os.makedirs(subfolder, exist_ok=True)
+        with open(os.path.join(subfolder, ticker.lower() + ".txt"), "w") as fileOut:
+            fileOut.write("<TICKER>,<PER>,<DATE>,<TIME>,<OPEN>,<HIGH>,<LOW>,<CLOSE>,<VOL>,<OPENINT>\n")
+            for ordinal, priceClose in zip(dates, closes):
+                fileOut.write(f"{ticker},D,{stooqData.ordinalToStooq(ordinal)},000000,{priceClose*0.99:.4f},{priceClose*1.01:.4f},{priceClose*0.98:.4f},{priceClose:.4f},{int(priceClose*7919) % 100000 * 100},0\n")
+        rows += len(dates)
+    return rows
+
+# The database packed into zip the way Stooq.com ships it
+def writeZip(folder, zipPath):
+    with zipfile.ZipFile(zipPath, "w", zipfile.ZIP_DEFLATED) as zipOut:
+        for path, subdirs, fileNames in os.walk(folder):
+            for fileName in sorted(fileNames):
+                zipOut.write(os.path.join(path, fileName), os.path.relpath(os.path.join(path, fileName), folder))
+
+# All metrics as they are configured in stockDigger, windows and dates moved to fit synthetic history
+def benchMetrics():
+    return [stockDigger.MetricRecentPeakRatio(totalDays = 5*365, peakedPastDays = 1, showTop = 20),
+            stockDigger.MetricPortfolioTrendlineAngle(totalDays = 5*365, origInvestment = 10000, showTop = 20),
+            stockDigger.MetricPortfolioStabilityPeak(totalDays = 5*365, ignorePriceBelow = 5, showTop = 20),
+            stockDigger.MetricPortfolioStabilityTotal(totalDays = 5*365, ignorePriceBelow = 5, declinesWeight = 5, showTop = 20),
+            stockDigger.MetricLargestDiffBetween(startDate = datetime.date(2020, 2, 19), endDate = datetime.date(2020, 6, 8), grewLongerThanDays = 1*365,
+                                                 grewMoreThanPercent = 20, ignoreLeveragedETFs = True, ignorePriceBelow = 15, showTop = 40),
+            stockDigger.MetricMinMaxAvgPriceBetween(startDate = datetime.date(2021, 4, 1), endDate = datetime.date(2021, 4, 30), ticker = "FB.US")]
+
+# The best of repeated runs in seconds, setup() prepares fresh arguments of every run outside of measured time
+def measure(repeat, run, setup=lambda: ()):
+    best = None
+    for _ in range(repeat):
+        arguments = setup()
+        gc.collect()
+        start = time.perf_counter()
+        run(*arguments)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def rank(metrics):
+    for metric in metrics:
+        scores = metric.calculate()
+        stockDigger.topTickers(scores, getattr(metric, "showTop", len(scores)))
+
+def update(feed, metrics, series, endOrdinal):
+    for ticker, dates, closes in series:
+        feed(metrics, ticker, dates, closes, endOrdinal)
+
+# Time of every phase of scan measured separately on the database folder: walk of the folder with manifest check,
+# reading files, splitting lines into fields with prices, parsing dates, bulk parsing of whole files instead of the
+# two previous phases, feeding metrics and ranking their scores
+def phaseTimings(folder, repeat):
+    stooqData.loadManifest(folder) # index files once, so walk measures only the check for changes
+    entries = stooqData.StooqFolder(folder).entries()
+    paths = [os.path.join(folder, entry["path"]) for entry in entries]
+    contents = [open(path, "rb").read() for path in paths]
+    dateFields, series = [], []
+    for entry, content in zip(entries, contents):
+        rows = [line.split(b",") for line in content.splitlines()[1:]]
+        dateFields.append([row[2] for row in rows])
+        if rows: series.append((entry["ticker"], array.array("i", map(stooqData.stooqToOrdinal, dateFields[-1])), array.array("d", (float(row[7]) for row in rows))))
+    endOrdinal = stockDigger.detectEndDate(entries).toordinal()
+    vectorFeed = stockDigger.feedSeries if stockDigger.np is not None else stockDigger.feedMetrics
+
+    def readFiles():
+        for path in paths:
+            with open(path, "rb") as fileIn: fileIn.read()
+
+    def parseLines():
+        for content in contents:
+            for line in content.splitlines()[1:]:
+                row = line.split(b",")
+                float(row[7])
+
+    def parseDates():
+        for dates in dateFields:
+            for sdate in dates: stooqData.stooqToOrdinal(sdate)
+
+    def parseBulk():
+        for path, content in zip(paths, contents):
+            stooqData.parseStooqBytes(content, ("close",), path)
+
+    def scanned():
+        metrics = benchMetrics()
+        update(vectorFeed, metrics, series, endOrdinal)
+        return (metrics,)
+
+    phases = {"walk": measure(repeat, lambda: stooqData.loadManifest(folder)),
+              "read": measure(repeat, readFiles),
+              "lineParse": measure(repeat, parseLines),
+              "dateParse": measure(repeat, parseDates),
+              "bulkParse": measure(repeat, parseBulk),
+              "metricUpdate": measure(repeat, update, lambda: (stockDigger.feedMetrics, benchMetrics(), series, endOrdinal))}
+    if stockDigger.np is not None:
+        phases["metricUpdateVectorized"] = measure(repeat, update, lambda: (stockDigger.feedSeries, benchMetrics(), series, endOrdinal))
+    phases["ranking"] = measure(repeat, rank, scanned)
+    return phases, series, endOrdinal
+
+# Rows per second of parsing dates and close prices line by line and in bulk, higher is better so it's not compared
+# for regressions like timings are
+def parseThroughput(phases, days):
+    return {"rows": days / (phases["lineParse"] + phases["dateParse"]), "bulk": days / phases["bulkParse"]}
+
+# Time of every metric alone fed with parsed prices day by day and vectorized
+def metricTimings(series, endOrdinal, repeat):
+    results = {}
+    for number, metric in enumerate(benchMetrics()):
+        fresh = lambda: [benchMetrics()[number]]
+        timings = results[type(metric).__name__] = {"rows": measure(repeat, update, lambda: (stockDigger.feedMetrics, fresh(), series, endOrdinal))}
+        if stockDigger.np is not None:
+            timings["vectorized"] = measure(repeat, update, lambda: (stockDigger.feedSeries, fresh(), series, endOrdinal))
+    return results
+
+# Whole scan like stockDigger does it: manifest (or cache index), needs of metrics, scan and ranking of the results
+def pipeline(path, vectorized):
+    source = stooqData.openSource(path)
+    entries = source.entries()
+    endOrdinal = stockDigger.detectEndDate(entries).toordinal()
+    metrics = benchMetrics()
+    needs = stooqData.DataNeeds.combine(metric.needs(endOrdinal) for metric in metrics)
+    entries = [entry for entry in entries if needs.wants(entry["ticker"])]
+    stockDigger.scanEntries(source, entries, metrics, endOrdinal, vectorized, ranges=needs.ranges)
+    rank(metrics)
+
+def pipelineTimings(folder, cacheDir, zipPath, repeat):
+    results = {"text": measure(repeat, pipeline, lambda: (folder, False)), "cache": measure(repeat, pipeline, lambda: (cacheDir, False)),
+               "zip": measure(repeat, pipeline, lambda: (zipPath, False))}
+    if stockDigger.np is not None:
+        results["textVectorized"] = measure(repeat, pipeline, lambda: (folder, True))
+        results["cacheVectorized"] = measure(repeat, pipeline, lambda: (cacheDir, True))
+    return results
+
+def profile(folder, profileFile):
+    profiler = cProfile.Profile()
+    profiler.runcall(pipeline, folder, False)
+    profiler.dump_stats(profileFile)
+    pstats.Stats(profileFile).sort_stats("cumulative").print_stats(15)
+
+# Print timings of a section, timings more than threshold slower than baseline are added to regressions
+def printTimings(timings, baseline, regressions, threshold, prefix=""):
+    for name, value in timings.items():
+        if isinstance(value, dict):
+            printTimings(value, (baseline or {}).get(name), regressions, threshold, prefix + name + ".")
+            continue
+        old = (baseline or {}).get(name)
+        line = f"  {prefix + name:<48} {value*1000:>10.1f} ms"
+        if isinstance(old, (int, float)) and old > 0:
+            line += f"  {value/old:>6.2f}x of {old*1000:.1f} ms"
+            if value > old * (1 + threshold):
+                line += "  REGRESSION"
+                regressions.append(prefix + name)
+        print(line)
+
+# Run all benchmarks on database folder (generated when not given), print them and compare with baseline JSON results
+def runBenchmarks(args):
+    folder, workDir = args.database, tempfile.mkdtemp(prefix="stockBench")
+    try:
+        if folder is None:
+            folder = os.path.join(workDir, "daily")
+            rows = writeDatabase(folder, args.tickers, args.history, args.gaps, args.seed)
+            print(f"Generated {args.tickers} tickers with {rows} days in {folder}")
+        cacheDir = os.path.join(workDir, "cache")
+        stooqData.compileDatabase(folder, cacheDir)
+        zipPath = os.path.join(workDir, "daily.zip")
+        writeZip(folder, zipPath)
+        stooqData.openSource(zipPath).entries() # index members once, so pipeline measures only the check for changes
+
+        phases, series, endOrdinal = phaseTimings(folder, args.repeat)
+        results = {"version": RESULTS_VERSION, "date": f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S}", "python": platform.python_version(),
+                   "numpy": stockDigger.np.__version__ if stockDigger.np is not None else None,
+                   "database": {"tickers": len(series), "days": sum(len(dates) for ticker, dates, closes in series),
+                                "generated": args.database is None, "history": args.history, "gaps": args.gaps, "seed": args.seed},
+                   "phases": phases,
+                   "throughput": parseThroughput(phases, sum(len(dates) for ticker, dates, closes in series)),
+                   "metrics": metricTimings(series, endOrdinal, args.repeat),
+                   "pipeline": pipelineTimings(folder, cacheDir, zipPath, args.repeat)}
+        if args.profile:
+            profile(folder, args.profile)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True) # generated database and its manifest are there too
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fileIn:
+            baseline = json.load(fileIn)
+    regressions = []
+    print(f"\nDatabase: {results['database']['tickers']} tickers, {results['database']['days']} days, best of {args.repeat} runs")
+    for section in ("phases", "metrics", "pipeline"):
+        print(f"\n{section.capitalize()}")
+        printTimings(results[section], (baseline or {}).get(section), regressions, args.threshold)
+    print("\nParse throughput")
+    for name, value in results["throughput"].items():
+        old = (baseline or {}).get("throughput", {}).get(name)
+        print(f"  {name:<48} {value:>10.0f} rows/s" + (f"  {value/old:>6.2f}x of {old:.0f} rows/s" if old else ""))
+    if args.json:
+        with open(args.json, "w") as fileOut:
+            json.dump(results, fileOut, indent=2)
+    if regressions:
+        print(f"\n{len(regressions)} timings are more than {args.threshold:.0%} slower than {args.compare}")
+        sys.exit(1)
+
+# The same state laid out as dicts keyed by ticker, one dict per column, the way metrics kept it before. Integer columns
+# don't have NaN, they have values of tickers that have any other value
+def stateAsDicts(metric):
+    present = {column: metric.present(column) for column, (typecode, missing) in metric.columns.items() if typecode == "d"}
+    counted = sorted(set().union(*present.values()))
+    return {column: {metric.tickers.names[i]: getattr(metric, column)[i] for i in present.get(column, counted)} for column in metric.columns}
+
+def allocated(build):
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    return result, tracemalloc.get_traced_memory()[0] - before
+
+# Memory of metric state kept in typed arrays compared to dicts keyed by ticker, ticker strings are shared by both layouts
+def memoryReport(tickers, history):
+    feed = stockDigger.feedSeries if stockDigger.np is not None else stockDigger.feedMetrics # days one by one is much slower
+    stockDigger.sharedTickers = stockDigger.TickerTable()
+    metrics = [stockDigger.MetricRecentPeakRatio(totalDays = 365, peakedPastDays = 10),
+               stockDigger.MetricPortfolioTrendlineAngle(totalDays = 365, origInvestment = 10000),
+               stockDigger.MetricPortfolioStabilityPeak(totalDays = 365, ignorePriceBelow = 5),
+               stockDigger.MetricPortfolioStabilityTotal(totalDays = 365, ignorePriceBelow = 5, declinesWeight = 5),
+               stockDigger.MetricLargestDiffBetween(startDate = datetime.date(2020, 2, 19), endDate = datetime.date(2020, 6, 8), grewLongerThanDays = 90)]
+    update(feed, metrics, syntheticSeries(tickers, history), END_DATE.toordinal())
+    table = stockDigger.sharedTickers
+    tableBytes = sys.getsizeof(table.ids) + sys.getsizeof(table.names)
+
+    print(f"\nMetric state of {tickers} tickers with up to {history} trading days\n")
+    print(f"{'Metric':<32} {'Tickers':>8} {'Dicts':>12} {'Arrays':>12}")
+    tracemalloc.start()
+    totalDicts, totalArrays = 0, tableBytes
+    for metric in metrics:
+        dicts, dictBytes = allocated(lambda: stateAsDicts(metric))
+        arrayBytes = sum(sys.getsizeof(getattr(metric, column)) for column in metric.columns)
+        counted = max(len(values) for values in dicts.values())
+        print(f"{type(metric).__name__:<32} {counted:>8} {dictBytes:>12,} {arrayBytes:>12,}")
+        totalDicts, totalArrays = totalDicts + dictBytes, totalArrays + arrayBytes
+        del dicts
+    tracemalloc.stop()
+    print(f"{'Ticker table':<32} {len(table.names):>8} {'':>12} {tableBytes:>12,}")
+    print(f"{'Total':<32} {'':>8} {totalDicts:>12,} {totalArrays:>12,}")
+
+    # top N of all scores: bounded heap against sorting everything
+    scores = metrics[2].calculate()
+    for name, select in (("sorted", lambda: sorted(scores, key=scores.get, reverse=True)[:20]), ("heap", lambda: stockDigger.topTickers(scores, 20))):
+        print(f"Top 20 of {len(scores)} scores with {name}: {measure(10, select)*1000:.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of stockDigger on synthetic Stooq.com database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def addDatabaseArguments(command):
+        command.add_argument("--tickers", type=int, default=500, help="number of tickers in synthetic database (default: %(default)s)")
+        command.add_argument("--history", type=int, default=2500, help="maximum number of trading days of ticker (default: %(default)s)")
+        command.add_argument("--gaps", type=float, default=0.02, help="probability that ticker misses a trading day (default: %(default)s)")
+        command.add_argument("--seed", type=int, default=2020, help="seed of random prices, the same seed gives the same database (default: %(default)s)")
+
+    generate = commands.add_parser("generate", help="write synthetic database in Stooq.com format")
+    generate.add_argument("folder", help="folder for the database, files go to FOLDER/data/daily/us/...")
+    addDatabaseArguments(generate)
+
+    run = commands.add_parser("run", help="run per-phase, metric and pipeline benchmarks")
+    run.add_argument("--database", help="Stooq database folder to use instead of generated one")
+    addDatabaseArguments(run)
+    run.add_argument("--repeat", type=int, default=3, help="run every benchmark N times and take the best time (default: %(default)s)")
+    run.add_argument("--json", metavar="FILE", help="write results to JSON file")
+    run.add_argument("--compare", metavar="FILE", help="compare with results of previous version from JSON file, exit with 1 on regressions")
+    run.add_argument("--threshold", type=float, default=0.1, help="slowdown treated as regression when comparing (default: %(default)s)")
+    run.add_argument("--profile", metavar="FILE", help="profile the pipeline with cProfile, save stats to FILE and print the top functions")
+
+    memory = commands.add_parser("memory", help="report memory of metric state in typed arrays against dicts")
+    memory.add_argument("--tickers", type=int, default=50000, help="number of tickers in synthetic database (default: %(default)s)")
+    memory.add_argument("--history", type=int, default=400, help="maximum number of trading days of ticker (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        rows = writeDatabase(args.folder, args.tickers, args.history, args.gaps, args.seed)
+        print(f"Generated {args.tickers} tickers with {rows} days in {args.folder}")
+    elif args.command == "run":
+        runBenchmarks(args)
+    else:
+        memoryReport(args.tickers, args.history)
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,23 @@
 # AG @ 2020
 import os
 import sys
-import traceback
+import argparse
+import concurrent.futures
+import copy
+import math
+import pickle
+import array
+import heapq
+import json
+import itertools
+import bisect
 import logging
 import datetime
-
-logging.basicConfig(filename="debug.log", filemode='a', format='%(asctime)s %(levelname)s %(funcName)s() - %(message)s', level=logging.DEBUG)
+import stooqData
+try:
+    import numpy as np
+except ImportError:
+    np = None # vectorized metrics are not available without NumPy
 
 leveragedETFs = {"TQQQ", "SSO", "QLD", "FLGE", "FIHD", "NUGT", "FBGX", "FRLG", "UPRO", "FAS", "TECL", "SPXL", "TVIX", "FIYY", "SOXL", "JNUG", "UYG", "TNA", "UWT", "UGAZ", "UVXY", "UCO", "UDOW", "BRZU", "ROM", "LABU", "YINN", "TMF", "MRRL", "DDM",
                  "USLV", "MORL", "UGLD", "FNGU", "ERX", "AGQ", "OILU", "EDC", "UWM", "GUSH", "BIB", "REML", "UGL", "URE", "CURE", "CEFL", "MVV", "CHAU", "DGP", "PFFA", "CEFZ", "BDCL", "EUO", "RXL", "LBDC", "USD", "MLPQ", "UBT", "FNGO", "NAIL",
@@ -15,149 +27,633 @@ leveragedETFs = {"TQQQ", "SSO", "QLD", "FLGE", "FIHD", "NUGT", "FBGX", "FRLG", "
                  "RETL", "FFEU", "WEBL", "PPSC", "CROC", "DTYL", "DTUL", "NEED", "EUFL", "DFVL", "WANT", "ULE", "UBR", "UJB", "EFO", "EZJ", "UPV", "TPOR", "DLBR", "HIBL", "LRET", "TAWK", "HOML", "YCL", "SMLL", "DUSL", "UGBP", "LTL", "FLEU",
                  "DEUR", "UCOM", "XCOM", "UEUR", "DAUD", "PPMC", "UCHF", "PPDM", "DGBP", "UJPY", "PPEM", "DJPY", "DCHF", "UAUD", "URR"}
 
+# Incremental mode gives expire() of metrics all days within this many calendar days after the days that left a window
+FOLLOWING_DAYS = 31
+
+# Index of the first day from which row-at-a-time add() starts to count ticker in metrics that require enough history,
+# it's the first day that is at least totalDays ago or None if ticker doesn't have such day
+def firstActiveDay(daysAgo, totalDays):
+    activated = np.flatnonzero(daysAgo >= totalDays)
+    return activated[0] if len(activated) else None
+
+# Precomputed tables of ticker prices shared by all configurations of metrics in sweep mode, so every configuration
+# costs a few lookups instead of another pass over the prices. Windows of metrics always end on database end date,
+# so sums are accumulated from the end (suffix sums) and every window sum is a sum of its own days only
+class SeriesTables():
+    def __init__(self, dates, closes, endOrdinal):
+        self.dates, self.closes, self.endOrdinal = dates, closes, endOrdinal
+        self.daysAgo = (endOrdinal - dates).astype(np.int64)
+        self.suffixes, self.declineSums, self.levels, self.drawdowns = None, None, None, {}
+
+    # index of the first day within last totalDays or None if ticker doesn't have enough history to be counted
+    def window(self, totalDays):
+        if not len(self.dates) or self.daysAgo[0] < totalDays: return None
+        return int(np.searchsorted(self.dates, self.endOrdinal - totalDays))
+
+    # index range [lo, hi) of days between two dates
+    def between(self, fromOrdinal, toOrdinal):
+        return int(np.searchsorted(self.dates, fromOrdinal)), int(np.searchsorted(self.dates, toOrdinal, side="right"))
+
+    def suffix(self, values):
+        return np.concatenate((np.cumsum(values[::-1])[::-1], [values.dtype.type(0)]))
+
+    # sums of prices, days ago, days ago squared and prices times days ago of the days from index lo to the end
+    def sums(self, lo):
+        if self.suffixes is None:
+            self.suffixes = [self.suffix(values) for values in (self.closes, self.daysAgo*self.closes, self.daysAgo, self.daysAgo*self.daysAgo)]
+        p, dp, d, d2 = (values[lo] for values in self.suffixes)
+        return len(self.dates) - lo, float(p), float(dp), int(d), int(d2)
+
+    # sum of relative declines between consecutive days from index lo to the end
+    def declines(self, lo):
+        if self.declineSums is None:
+            prev, drops = self.closes[:-1], self.closes[:-1] - self.closes[1:]
+            declines = np.divide(drops, prev, out=np.zeros(len(drops)), where=drops > 0)
+            self.declineSums = self.suffix(np.concatenate(([0.0], declines))) # declines[i] is decline into day i
+        return float(self.declineSums[lo + 1]) if lo + 1 < len(self.dates) else 0.0
+
+    # maximum price of days from index lo to hi (exclusive) from sparse table of maxima of power of two long ranges
+    def rangeMax(self, lo, hi):
+        if hi <= lo: return 0
+        if self.levels is None:
+            self.levels = [self.closes]
+            while 1 << len(self.levels) <= len(self.closes):
+                step = 1 << (len(self.levels) - 1)
+                self.levels.append(np.maximum(self.levels[-1][:-step], self.levels[-1][step:]))
+        level = (hi - lo).bit_length() - 1
+        return float(max(self.levels[level][lo], self.levels[level][hi - (1 << level)]))
+
+    # maximum loss from local high and the last local high of days from index lo to the end, the same way addSeries() does
+    def drawdown(self, lo):
+        if lo not in self.drawdowns:
+            prices = self.closes[lo:]
+            highs = np.maximum.accumulate(prices)
+            self.drawdowns[lo] = min(1, float((prices / highs).min())), float(highs[-1])
+        return self.drawdowns[lo]
+
+# Interning table of tickers: metrics keep their state in typed arrays indexed by ticker id instead of dicts keyed by ticker
+class TickerTable():
+    def __init__(self):
+        self.ids, self.names = {}, []
+
+    def id(self, ticker):
+        i = self.ids.get(ticker)
+        if i is None:
+            i = self.ids[ticker] = len(self.names)
+            self.names.append(ticker)
+        return i
+
+# Metrics created in this process share one table, so every ticker string is stored once. Metrics pickled together
+# (worker processes, checkpoints) keep sharing their own copy of it, merge() maps tickers of other table by name
+sharedTickers = TickerTable()
+
+def valueOr(value, default):
+    return default if value != value else value # NaN marks ticker without value
+
+# Metric state as struct of arrays: every column is a typed array as long as the table of tickers, tickers without
+# state hold missing value of the column (NaN for prices). Column with NaN tells whether ticker is counted at all
+class MetricState():
+    columns = {} # column name: (array typecode, missing value)
+
+    def initState(self, tickers):
+        self.tickers, self.size = tickers or sharedTickers, 0
+        self.lastTicker, self.lastId = None, None # add() gets the same ticker for all its days
+        for name, (typecode, missing) in self.columns.items():
+            setattr(self, name, array.array(typecode))
+
+    # id of ticker, arrays grow to hold it
+    def slot(self, ticker):
+        i = self.tickers.ids.get(ticker)
+        if i is None or i >= self.size:
+            i, size = self.tickers.id(ticker), len(self.tickers.names)
+            for name, (typecode, missing) in self.columns.items():
+                getattr(self, name).extend([missing] * (size - self.size))
+            self.size = size
+        self.lastTicker, self.lastId = ticker, i
+        return i
+
+    # ids of tickers that have value in column
+    def present(self, column):
+        return [i for i, value in enumerate(getattr(self, column)) if value == value]
+
+    def forget(self, ticker):
+        i = self.tickers.ids.get(ticker)
+        if i is not None and i < self.size:
+            for name, (typecode, missing) in self.columns.items():
+                getattr(self, name)[i] = missing
+
+    # ids in this table of tickers in other metric's table
+    def mapping(self, other):
+        return [self.slot(ticker) for ticker in other.tickers.names[:other.size]]
+
+    # merge partial state collected by another process from different tickers, values of other metric replace own ones
+    def merge(self, other):
+        for j, i in enumerate(self.mapping(other)):
+            for name in self.columns:
+                value = getattr(other, name)[j]
+                if value == value:
+                    getattr(self, name)[i] = value
+
+# Top N tickers by score with bounded heap instead of sorting all scores, ties keep the order of scores like sorted() does
+def topTickers(scores, showTop):
+    return heapq.nlargest(showTop, scores, key=scores.get)
+
 # Metric : ratio of recent maximum to previous maximum
-class MetricRecentPeakRatio():
+class MetricRecentPeakRatio(MetricState):
+    byDate = False # add() receives number of days ago from database end date
+    columns = {"pastMax": ("d", math.nan), "recentMax": ("d", math.nan)}
+
     def __init__(self, *args, **kwds):
         self.totalDays = kwds.pop("totalDays", 365) # only consider how stock performed during last N days
         self.peakedPastDays = kwds.pop("peakedPastDays", 10) # recent maximum time window in days
         self.showTop = kwds.pop("showTop", 20) # show top N winners
-        self.scores, self.pastMax, self.recentMax = {}, {}, {}
+        self.initState(kwds.pop("tickers", None))
+        self.scores = {}
+
+    # only days of the last totalDays are needed, the day before them tells that ticker has enough history
+    def needs(self, endOrdinal):
+        return stooqData.DataNeeds(ranges=[(endOrdinal - self.totalDays, None)])
 
     def add(self, ticker, daysAgo, priceClose):
-        if ticker not in self.pastMax:
-            self.pastMax[ticker] = self.recentMax[ticker] = 0
+        i = self.lastId if ticker is self.lastTicker else self.slot(ticker)
+        if self.pastMax[i] != self.pastMax[i]:
+            self.pastMax[i] = self.recentMax[i] = 0
         if daysAgo <= self.totalDays: # skip older data
             if daysAgo > self.peakedPastDays:
-                self.pastMax[ticker] = max(self.pastMax[ticker], priceClose)
+                self.pastMax[i] = max(self.pastMax[i], priceClose)
             else:
-                self.recentMax[ticker] = max(self.recentMax[ticker], priceClose)
+                self.recentMax[i] = max(self.recentMax[i], priceClose)
+
+    # vectorized version of add() for all days of ticker at once: running maxima of both time windows
+    def addSeries(self, ticker, dates, closes, endOrdinal):
+        i = self.slot(ticker)
+        daysAgo = endOrdinal - dates
+        inWindow = daysAgo <= self.totalDays
+        recent = daysAgo <= self.peakedPastDays
+        self.pastMax[i] = max(valueOr(self.pastMax[i], 0), float(closes[inWindow & ~recent].max(initial=0)))
+        self.recentMax[i] = max(valueOr(self.recentMax[i], 0), float(closes[inWindow & recent].max(initial=0)))
+
+    # sweep version of addSeries() from precomputed tables: range maxima of both time windows
+    def addTables(self, ticker, tables):
+        i = self.slot(ticker)
+        end = tables.endOrdinal
+        past = tables.rangeMax(*tables.between(end - self.totalDays, end - self.peakedPastDays - 1))
+        recent = tables.rangeMax(*tables.between(end - min(self.totalDays, self.peakedPastDays), end))
+        self.pastMax[i] = max(valueOr(self.pastMax[i], 0), past)
+        self.recentMax[i] = max(valueOr(self.recentMax[i], 0), recent)
+
+    # thresholds of days ago where days move from recent to past window and leave past window when end date moves forward
+    def windows(self):
+        return sorted({self.totalDays, self.peakedPastDays}, reverse=True)
+
+    # nothing depends on end date itself
+    def shift(self, days):
+        pass
+
+    # days that moved to the past window raise its maximum and recent maximum is found again among following days,
+    # returns False if ticker has to be calculated again because maximum could drop
+    def expire(self, ticker, threshold, crossed, following):
+        i = self.slot(ticker)
+        if self.pastMax[i] != self.pastMax[i] or not crossed: return True
+        if threshold == self.peakedPastDays: # moved from recent window to the past one (or out of both)
+            for daysAgo, priceClose in crossed:
+                if daysAgo <= self.totalDays:
+                    self.pastMax[i] = max(self.pastMax[i], priceClose)
+            if self.peakedPastDays > FOLLOWING_DAYS: # following days don't cover whole recent window
+                return max(priceClose for daysAgo, priceClose in crossed) < self.recentMax[i]
+            self.recentMax[i] = max([priceClose for daysAgo, priceClose in following if daysAgo <= self.totalDays], default=0)
+            return True
+        return max(priceClose for daysAgo, priceClose in crossed) < self.pastMax[i] # left the past window
+
+    # merge partial state collected by another process from different tickers
+    def merge(self, other):
+        for j, i in enumerate(self.mapping(other)):
+            if other.pastMax[j] == other.pastMax[j]:
+                self.pastMax[i] = max(valueOr(self.pastMax[i], 0), other.pastMax[j])
+                self.recentMax[i] = max(valueOr(self.recentMax[i], 0), other.recentMax[j])
+
+    # calculate scores of all tickers from collected data
+    def calculate(self):
+        self.scores = {}
+        for i in self.present("recentMax"):
+            if self.pastMax[i] > 0:
+                ticker = self.tickers.names[i]
+                self.scores[ticker] = self.recentMax[i] / self.pastMax[i]
+                logging.debug("RecentPeakRatio %s: %.3f / %.3f = %.3f", ticker, self.recentMax[i], self.pastMax[i], self.scores[ticker])
+        return self.scores
 
     def printResults(self):
         print(f"\n\n** Metric - Recent Peak Ratio **\n")
         print(f"totalDays = {self.totalDays}")
         print(f"peakedPastDays = {self.peakedPastDays}\n")
-        for ticker in self.recentMax:
-            if self.pastMax[ticker] > 0:
-                self.scores[ticker] = self.recentMax[ticker] / self.pastMax[ticker]
-                logging.debug(f"RecentPeakRatio {ticker}: {self.recentMax[ticker]:.3f} / {self.pastMax[ticker]:.3f} = {self.scores[ticker]:.3f}")
-        for place, ticker in zip(range(self.showTop), sorted(self.scores, key=self.scores.get, reverse=True)[:self.showTop]):
+        self.calculate()
+        for place, ticker in enumerate(topTickers(self.scores, self.showTop)):
             print(f"#{place+1:<3}: {ticker:<8} - {self.scores.get(ticker, 0):.3f}")
 
 # Metric : portfolio value trend line angle
-class MetricPortfolioTrendlineAngle():
+class MetricPortfolioTrendlineAngle(MetricState):
+    byDate = False # add() receives number of days ago from database end date
+    # least squares sums use price instead of portfolio value y = numStocks*price, so days can be removed from them
+    # when portfolio starts on another day, numStocks is applied to the slope at the end
+    columns = {"numStocks": ("d", math.nan), "xp": ("d", math.nan), "x": ("q", 0), "p": ("d", math.nan), "x2": ("q", 0), "n": ("q", 0)}
+
     def __init__(self, *args, **kwds):
         self.totalDays = kwds.pop("totalDays", 365) # only consider how stock performed during last N days
         self.origInvestment = kwds.pop("origInvestment", 10000) # USD
         self.showTop = kwds.pop("showTop", 20) # show top N winners
-        self.scores, self.numStocks, self.xy, self.x, self.y, self.x2, self.n = {}, {}, {}, {}, {}, {}, {}
+        self.initState(kwds.pop("tickers", None))
+        self.scores = {}
+
+    # only days of the last totalDays are needed, the day before them tells that ticker has enough history
+    def needs(self, endOrdinal):
+        return stooqData.DataNeeds(ranges=[(endOrdinal - self.totalDays, None)])
 
     def add(self, ticker, daysAgo, priceClose):
-        if ticker not in self.xy and daysAgo >= self.totalDays: # don't count stocks that don't have enough history
-            self.xy[ticker] = self.x[ticker] = self.y[ticker] = self.x2[ticker] = self.n[ticker] = 0
-        if ticker in self.xy and daysAgo <= self.totalDays: # skip older data
+        i = self.lastId if ticker is self.lastTicker else self.slot(ticker)
+        if self.xp[i] != self.xp[i] and daysAgo >= self.totalDays: # don't count stocks that don't have enough history
+            self.xp[i] = self.x[i] = self.p[i] = self.x2[i] = self.n[i] = 0
+        if self.xp[i] == self.xp[i] and daysAgo <= self.totalDays: # skip older data
             if ticker == "BRK-A.US": priceClose /= 1000 # workaround to prevent strange results when price is too high (Berkshire Hathaway)
-            if ticker not in self.numStocks:
-                self.numStocks[ticker] = self.origInvestment / priceClose # initialize portfolio on the first day
-            x, y = self.totalDays - daysAgo, self.numStocks[ticker]*priceClose
-            self.xy[ticker] += x*y
-            self.x[ticker] += x
-            self.y[ticker] += y
-            self.x2[ticker] += x*x
-            self.n[ticker] += 1
+            if self.numStocks[i] != self.numStocks[i]:
+                self.numStocks[i] = self.origInvestment / priceClose # initialize portfolio on the first day
+            x = self.totalDays - daysAgo
+            self.xp[i] += x*priceClose
+            self.x[i] += x
+            self.p[i] += priceClose
+            self.x2[i] += x*x
+            self.n[i] += 1
+
+    # vectorized version of add() for all days of ticker at once: closed-form least squares sums
+    def addSeries(self, ticker, dates, closes, endOrdinal):
+        i = self.slot(ticker)
+        daysAgo = endOrdinal - dates
+        if self.xp[i] != self.xp[i]:
+            first = firstActiveDay(daysAgo, self.totalDays)
+            if first is None: return
+            self.xp[i] = self.x[i] = self.p[i] = self.x2[i] = self.n[i] = 0
+            daysAgo, closes = daysAgo[first:], closes[first:]
+        inWindow = daysAgo <= self.totalDays
+        daysAgo, prices = daysAgo[inWindow], closes[inWindow]
+        if not len(prices): return
+        if ticker == "BRK-A.US": prices = prices / 1000 # workaround to prevent strange results when price is too high (Berkshire Hathaway)
+        if self.numStocks[i] != self.numStocks[i]:
+            self.numStocks[i] = self.origInvestment / float(prices[0]) # initialize portfolio on the first day
+        x = (self.totalDays - daysAgo).astype(np.int64)
+        self.xp[i] += float((x*prices).sum())
+        self.x[i] += int(x.sum())
+        self.p[i] += float(prices.sum())
+        self.x2[i] += int((x*x).sum())
+        self.n[i] += len(x)
+
+    # sweep version of addSeries() from precomputed tables: least squares sums from suffix sums, x = totalDays - daysAgo
+    def addTables(self, ticker, tables):
+        i = self.slot(ticker)
+        lo = tables.window(self.totalDays)
+        if lo is None: return
+        n, p, dp, d, d2 = tables.sums(lo)
+        self.xp[i] = self.x[i] = self.p[i] = self.x2[i] = self.n[i] = 0
+        if not n: return
+        scale = 1000 if ticker == "BRK-A.US" else 1 # workaround to prevent strange results when price is too high (Berkshire Hathaway)
+        self.numStocks[i] = self.origInvestment / (float(tables.closes[lo]) / scale) # initialize portfolio on the first day
+        self.xp[i] = (self.totalDays*p - dp) / scale
+        self.x[i] = self.totalDays*n - d
+        self.p[i] = p / scale
+        self.x2[i] = self.totalDays*self.totalDays*n - 2*self.totalDays*d + d2
+        self.n[i] = n
+
+    # thresholds of days ago where days leave the window when end date moves forward
+    def windows(self):
+        return [self.totalDays]
+
+    # end date moved forward by N days, so every day has N smaller x now
+    def shift(self, days):
+        for i in self.present("xp"):
+            self.xp[i] -= days*self.p[i]
+            self.x2[i] += -2*days*self.x[i] + days*days*self.n[i]
+            self.x[i] -= days*self.n[i]
+
+    # days that left the window after end date moved forward are removed from sums, portfolio starts on the following day,
+    # returns False if ticker has to be calculated again because it wasn't counted before
+    def expire(self, ticker, threshold, crossed, following):
+        i = self.slot(ticker)
+        following = following[0] if following else None
+        if self.xp[i] != self.xp[i]: # becomes counted once it has enough history, its days in the window weren't added
+            return not crossed and (following is None or following[0] < self.totalDays)
+        if not crossed: return True
+        for daysAgo, priceClose in crossed:
+            if ticker == "BRK-A.US": priceClose /= 1000
+            x = self.totalDays - daysAgo
+            self.xp[i] -= x*priceClose
+            self.x[i] -= x
+            self.p[i] -= priceClose
+            self.x2[i] -= x*x
+            self.n[i] -= 1
+        if self.n[i] == 0:
+            self.xp[i] = self.p[i] = 0 # drop rounding leftovers
+        if following:
+            self.numStocks[i] = self.origInvestment / (following[1] / 1000 if ticker == "BRK-A.US" else following[1])
+        else:
+            self.numStocks[i] = math.nan
+        return True
+
+    # merge partial state collected by another process from different tickers
+    def merge(self, other):
+        for j, i in enumerate(self.mapping(other)):
+            if other.xp[j] == other.xp[j]:
+                self.xp[i] = valueOr(self.xp[i], 0) + other.xp[j]
+                self.x[i] += other.x[j]
+                self.p[i] = valueOr(self.p[i], 0) + other.p[j]
+                self.x2[i] += other.x2[j]
+                self.n[i] += other.n[j]
+            if self.numStocks[i] != self.numStocks[i]:
+                self.numStocks[i] = other.numStocks[j]
+
+    # calculate scores of all tickers from collected data
+    def calculate(self):
+        self.scores = {}
+        for i in self.present("xp"):
+            divisor = self.n[i]*self.x2[i] - self.x[i]*self.x[i]
+            if divisor != 0:
+                ticker = self.tickers.names[i]
+                self.scores[ticker] = self.numStocks[i] * (self.n[i]*self.xp[i] - self.x[i]*self.p[i]) / divisor
+                logging.debug("PortfolioTrendlineAngle %s: %.3f, numStocks = %.1f", ticker, self.scores[ticker], self.numStocks[i])
+        return self.scores
 
     def printResults(self):
         print(f"\n\n** Metric - Portfolio Trend Line Angle **\n")
         print(f"totalDays = {self.totalDays}")
         print(f"origInvestment = {self.origInvestment}\n")
-        for ticker in self.xy:
-            divisor = self.n[ticker]*self.x2[ticker] - self.x[ticker]*self.x[ticker]
-            if divisor != 0:
-                self.scores[ticker] = (self.n[ticker]*self.xy[ticker] - self.x[ticker]*self.y[ticker]) / divisor
-                logging.debug(f"PortfolioTrendlineAngle {ticker}: {self.scores[ticker]:.3f}, numStocks = {self.numStocks[ticker]:.1f}")
-        for place, ticker in zip(range(self.showTop), sorted(self.scores, key=self.scores.get, reverse=True)[:self.showTop]):
+        self.calculate()
+        for place, ticker in enumerate(topTickers(self.scores, self.showTop)):
             print(f"#{place+1:<3}: {ticker:<8} - {self.scores[ticker]:.3f}")
         if "SPY.US" in self.scores:
             print(f"#BENCHMARK SPY - {self.scores['SPY.US']:<6.3f}")
 
 # Metric : Portfolio Appreciation Stability Peak Adjusted = Growth Ratio * Maximum Experienced Decline Ratio
-class MetricPortfolioStabilityPeak():
+class MetricPortfolioStabilityPeak(MetricState):
+    byDate = False # add() receives number of days ago from database end date
+    columns = {"start": ("d", math.nan), "finish": ("d", math.nan), "localHigh": ("d", math.nan), "maxLossSoFar": ("d", math.nan)}
+
     def __init__(self, *args, **kwds):
         self.totalDays = kwds.pop("totalDays", 365) # only consider how stock performed during last N days
         self.ignorePriceBelow = kwds.pop("ignorePriceBelow", 5) # don't consider stocks that cost below X on start
         self.showTop = kwds.pop("showTop", 20) # show top N winners
-        self.scores, self.start, self.finish, self.localHigh, self.maxLossSoFar = {}, {}, {}, {}, {}
+        self.initState(kwds.pop("tickers", None))
+        self.scores = {}
+
+    # only days of the last totalDays are needed, the day before them tells that ticker has enough history
+    def needs(self, endOrdinal):
+        return stooqData.DataNeeds(ranges=[(endOrdinal - self.totalDays, None)])
 
     def add(self, ticker, daysAgo, priceClose):
-        if ticker not in self.localHigh and daysAgo >= self.totalDays: # don't count stocks that don't have enough history
-            self.localHigh[ticker], self.maxLossSoFar[ticker] = 0, 1
-        if ticker in self.localHigh and daysAgo <= self.totalDays: # skip older data
-            if ticker not in self.start:
+        i = self.lastId if ticker is self.lastTicker else self.slot(ticker)
+        if self.localHigh[i] != self.localHigh[i] and daysAgo >= self.totalDays: # don't count stocks that don't have enough history
+            self.localHigh[i], self.maxLossSoFar[i] = 0, 1
+        if self.localHigh[i] == self.localHigh[i] and daysAgo <= self.totalDays: # skip older data
+            if self.start[i] != self.start[i]:
                 if priceClose < self.ignorePriceBelow:
-                    del self.localHigh[ticker] # stops processing of this ticker
+                    self.localHigh[i] = math.nan # stops processing of this ticker
                     return
                 else:
-                    self.start[ticker] = priceClose # capture first day
-            self.finish[ticker] = priceClose # will capture last day
-            if self.localHigh[ticker] < priceClose: # update local price maximum if found
-                self.localHigh[ticker] = priceClose
+                    self.start[i] = priceClose # capture first day
+            self.finish[i] = priceClose # will capture last day
+            if self.localHigh[i] < priceClose: # update local price maximum if found
+                self.localHigh[i] = priceClose
             else:
-                self.maxLossSoFar[ticker] = min(self.maxLossSoFar[ticker], priceClose / self.localHigh[ticker]) # update maximum encountered loss so far
+                self.maxLossSoFar[i] = min(self.maxLossSoFar[i], priceClose / self.localHigh[i]) # update maximum encountered loss so far
+
+    # vectorized version of add() for all days of ticker at once: cumulative maximum and drawdown from it
+    def addSeries(self, ticker, dates, closes, endOrdinal):
+        i = self.slot(ticker)
+        daysAgo = endOrdinal - dates
+        if self.localHigh[i] != self.localHigh[i]:
+            first = firstActiveDay(daysAgo, self.totalDays)
+            if first is None: return
+            self.localHigh[i], self.maxLossSoFar[i] = 0, 1
+            daysAgo, closes = daysAgo[first:], closes[first:]
+        prices = closes[daysAgo <= self.totalDays]
+        if not len(prices): return
+        if self.start[i] != self.start[i]:
+            if prices[0] < self.ignorePriceBelow:
+                self.localHigh[i] = math.nan # stops processing of this ticker
+                return
+            self.start[i] = float(prices[0]) # capture first day
+        self.finish[i] = float(prices[-1]) # capture last day
+        highs = np.maximum(np.maximum.accumulate(prices), self.localHigh[i]) # local price maximum on every day
+        self.maxLossSoFar[i] = min(self.maxLossSoFar[i], float((prices / highs).min())) # days with new maximum have ratio 1
+        self.localHigh[i] = float(highs[-1])
+
+    # sweep version of addSeries() from precomputed tables: drawdown is shared by configurations with the same totalDays
+    def addTables(self, ticker, tables):
+        i = self.slot(ticker)
+        lo = tables.window(self.totalDays)
+        if lo is None: return
+        self.localHigh[i], self.maxLossSoFar[i] = 0, 1
+        if lo == len(tables.closes): return
+        if tables.closes[lo] < self.ignorePriceBelow:
+            self.localHigh[i] = math.nan # stops processing of this ticker
+            return
+        self.start[i], self.finish[i] = float(tables.closes[lo]), float(tables.closes[-1])
+        self.maxLossSoFar[i], self.localHigh[i] = tables.drawdown(lo)
+
+    # thresholds of days ago where days leave the window when end date moves forward
+    def windows(self):
+        return [self.totalDays]
+
+    # nothing depends on end date itself
+    def shift(self, days):
+        pass
+
+    # days that left the window after end date moved forward, portfolio starts on the following day, returns False
+    # if ticker has to be calculated again because local highs or maximum loss could depend on the days that left
+    def expire(self, ticker, threshold, crossed, following):
+        i = self.slot(ticker)
+        following, days = (following[0] if following else None), following
+        if self.start[i] != self.start[i]:
+            if self.localHigh[i] == self.localHigh[i] or not crossed and (following is None or following[0] < self.totalDays):
+                return not crossed # nothing was counted in the window yet
+            if following is None: # has enough history now, but no days in the window
+                self.localHigh[i], self.maxLossSoFar[i] = 0, 1
+                return True
+            return following[1] < self.ignorePriceBelow # stays stopped, otherwise its days weren't counted
+        if not crossed: return True
+        if following is None or following[1] < self.ignorePriceBelow:
+            self.forget(ticker)
+            if following is None: # has no days in the window anymore
+                self.localHigh[i], self.maxLossSoFar[i] = 0, 1
+            return True
+        high, maxLoss = 0, 1
+        for daysAgo, priceClose in crossed:
+            if high < priceClose: high = priceClose
+            else: maxLoss = min(maxLoss, priceClose / high)
+        # following days below the highest price that left were measured against it, if one of them had maximum loss
+        # it's not known anymore, otherwise their loss only gets smaller and maximum loss stays the same
+        for daysAgo, priceClose in days:
+            if priceClose >= high: break
+            maxLoss = min(maxLoss, priceClose / high)
+        else:
+            return False # local high could change for the rest of the window
+        if maxLoss <= self.maxLossSoFar[i] < 1:
+            return False
+        self.start[i] = following[1]
+        return True
+
+    # calculate scores of all tickers from collected data
+    def calculate(self):
+        self.scores = {}
+        for i in self.present("start"):
+            if self.start[i] != 0:
+                ticker = self.tickers.names[i]
+                self.scores[ticker] = self.maxLossSoFar[i] * self.finish[i] / self.start[i]
+                logging.debug("PortfolioStabilityPeak %s: %.3f, start = %.2f, finish = %.2f, maxLossSoFar = %.2f", ticker, self.scores[ticker], self.start[i], self.finish[i], self.maxLossSoFar[i])
+        return self.scores
 
     def printResults(self):
         print(f"\n\n** Metric - Portfolio Appreciation Stability Peak Adjusted (PASPA) **\n")
         print(f"totalDays = {self.totalDays}")
         print(f"ignorePriceBelow = {self.ignorePriceBelow}\n")
-        for ticker in self.start:
-            if self.start[ticker] != 0:
-                self.scores[ticker] = self.maxLossSoFar[ticker] * self.finish[ticker] / self.start[ticker]
-                logging.debug(f"PortfolioStabilityPeak {ticker}: {self.scores[ticker]:.3f}, start = {self.start[ticker]:.2f}, finish = {self.finish[ticker]:.2f}, maxLossSoFar = {self.maxLossSoFar[ticker]:.2f}")
-        for place, ticker in zip(range(self.showTop), sorted(self.scores, key=self.scores.get, reverse=True)[:self.showTop]):
-            print(f"#{place+1:<3}: {ticker:<8} - {self.scores[ticker]:<6.3f}  = Growth {self.finish[ticker] / self.start[ticker]:<6.3f} * Stability {self.maxLossSoFar[ticker]:.3f}")
+        self.calculate()
+        for place, ticker in enumerate(topTickers(self.scores, self.showTop)):
+            i = self.tickers.ids[ticker]
+            print(f"#{place+1:<3}: {ticker:<8} - {self.scores[ticker]:<6.3f}  = Growth {self.finish[i] / self.start[i]:<6.3f} * Stability {self.maxLossSoFar[i]:.3f}")
         if "SPY.US" in self.scores:
-            print(f"#BENCHMARK SPY - {self.scores['SPY.US']:<6.3f}  = Growth {self.finish['SPY.US'] / self.start['SPY.US']:<6.3f} * Stability {self.maxLossSoFar['SPY.US']:.3f}")
-            
+            i = self.tickers.ids["SPY.US"]
+            print(f"#BENCHMARK SPY - {self.scores['SPY.US']:<6.3f}  = Growth {self.finish[i] / self.start[i]:<6.3f} * Stability {self.maxLossSoFar[i]:.3f}")
+
 # Metric : Portfolio Appreciation Stability Total Adjusted = Growth Ratio - Avg Total Declines per Year
-class MetricPortfolioStabilityTotal():
+class MetricPortfolioStabilityTotal(MetricState):
+    byDate = False # add() receives number of days ago from database end date
+    columns = {"start": ("d", math.nan), "finish": ("d", math.nan), "declines": ("d", math.nan), "prevClose": ("d", math.nan)}
+
     def __init__(self, *args, **kwds):
         self.totalDays = kwds.pop("totalDays", 365) # only consider how stock performed during last N days
         self.ignorePriceBelow = kwds.pop("ignorePriceBelow", 5) # don't consider stocks that cost below X on start
         self.declinesWeight = kwds.pop("declinesWeight", 1) # 0 - declines have no effect, >1 - declines have extra weight
         self.showTop = kwds.pop("showTop", 20) # show top N winners
-        self.scores, self.start, self.finish, self.declines, self.prevClose = {}, {}, {}, {}, {}
+        self.initState(kwds.pop("tickers", None))
+        self.scores = {}
+
+    # only days of the last totalDays are needed, the day before them tells that ticker has enough history
+    def needs(self, endOrdinal):
+        return stooqData.DataNeeds(ranges=[(endOrdinal - self.totalDays, None)])
 
     def add(self, ticker, daysAgo, priceClose):
-        if ticker not in self.declines and daysAgo >= self.totalDays: # don't count stocks that don't have enough history
-            self.declines[ticker] = 0
-        if ticker in self.declines and daysAgo <= self.totalDays: # skip older data
-            if ticker not in self.start:
+        i = self.lastId if ticker is self.lastTicker else self.slot(ticker)
+        if self.declines[i] != self.declines[i] and daysAgo >= self.totalDays: # don't count stocks that don't have enough history
+            self.declines[i] = 0
+        if self.declines[i] == self.declines[i] and daysAgo <= self.totalDays: # skip older data
+            if self.start[i] != self.start[i]:
                 if priceClose < self.ignorePriceBelow:
-                    del self.declines[ticker] # stops processing of this ticker
+                    self.declines[i] = math.nan # stops processing of this ticker
                     return
                 else:
-                    self.start[ticker] = priceClose # capture first day
-            self.finish[ticker] = priceClose # will capture last day
-            if ticker in self.prevClose:
-                if self.prevClose[ticker] > priceClose: # decline detected, add it up
-                    self.declines[ticker] += (self.prevClose[ticker] - priceClose) / self.prevClose[ticker]
-            self.prevClose[ticker] = priceClose
+                    self.start[i] = priceClose # capture first day
+            self.finish[i] = priceClose # will capture last day
+            if self.prevClose[i] == self.prevClose[i]:
+                if self.prevClose[i] > priceClose: # decline detected, add it up
+                    self.declines[i] += (self.prevClose[i] - priceClose) / self.prevClose[i]
+            self.prevClose[i] = priceClose
+
+    # vectorized version of add() for all days of ticker at once: summed negative daily returns
+    def addSeries(self, ticker, dates, closes, endOrdinal):
+        i = self.slot(ticker)
+        daysAgo = endOrdinal - dates
+        if self.declines[i] != self.declines[i]:
+            first = firstActiveDay(daysAgo, self.totalDays)
+            if first is None: return
+            self.declines[i] = 0
+            daysAgo, closes = daysAgo[first:], closes[first:]
+        prices = closes[daysAgo <= self.totalDays]
+        if not len(prices): return
+        if self.start[i] != self.start[i]:
+            if prices[0] < self.ignorePriceBelow:
+                self.declines[i] = math.nan # stops processing of this ticker
+                return
+            self.start[i] = float(prices[0]) # capture first day
+        self.finish[i] = float(prices[-1]) # capture last day
+        if self.prevClose[i] == self.prevClose[i]:
+            prices = np.concatenate(([self.prevClose[i]], prices))
+        prev, drops = prices[:-1], prices[:-1] - prices[1:]
+        declined = drops > 0 # decline detected, add it up
+        self.declines[i] += float((drops[declined] / prev[declined]).sum())
+        self.prevClose[i] = float(prices[-1])
+
+    # sweep version of addSeries() from precomputed tables: declines from suffix sums of daily declines
+    def addTables(self, ticker, tables):
+        i = self.slot(ticker)
+        lo = tables.window(self.totalDays)
+        if lo is None: return
+        self.declines[i] = 0
+        if lo == len(tables.closes): return
+        if tables.closes[lo] < self.ignorePriceBelow:
+            self.declines[i] = math.nan # stops processing of this ticker
+            return
+        self.start[i], self.finish[i] = float(tables.closes[lo]), float(tables.closes[-1])
+        self.declines[i] = tables.declines(lo)
+        self.prevClose[i] = float(tables.closes[-1])
+
+    # thresholds of days ago where days leave the window when end date moves forward
+    def windows(self):
+        return [self.totalDays]
+
+    # nothing depends on end date itself
+    def shift(self, days):
+        pass
+
+    # declines between days that left the window after end date moved forward are removed from the total, portfolio starts
+    # on the following day, returns False if ticker has to be calculated again because it wasn't counted before
+    def expire(self, ticker, threshold, crossed, following):
+        i = self.slot(ticker)
+        following = following[0] if following else None
+        if self.start[i] != self.start[i]:
+            if self.declines[i] == self.declines[i] or not crossed and (following is None or following[0] < self.totalDays):
+                return not crossed # nothing was counted in the window yet
+            if following is None: # has enough history now, but no days in the window
+                self.declines[i] = 0
+                return True
+            return following[1] < self.ignorePriceBelow # stays stopped, otherwise its days weren't counted
+        if not crossed: return True
+        if following is None or following[1] < self.ignorePriceBelow:
+            self.forget(ticker)
+            if following is None: # has no days in the window anymore
+                self.declines[i] = 0
+            return True
+        prices = [priceClose for daysAgo, priceClose in crossed] + [following[1]]
+        for prevClose, priceClose in zip(prices, prices[1:]):
+            if prevClose > priceClose:
+                self.declines[i] -= (prevClose - priceClose) / prevClose
+        self.start[i] = following[1]
+        return True
+
+    # calculate scores of all tickers from collected data
+    def calculate(self):
+        self.scores, self.yearlyDeclines = {}, {}
+        for i in self.present("start"):
+            if self.start[i] != 0:
+                ticker = self.tickers.names[i]
+                self.yearlyDeclines[ticker] = self.declines[i] * self.declinesWeight * 365/self.totalDays # trying to decrease effect of declines
+                self.scores[ticker] = self.finish[i] / self.start[i] - self.yearlyDeclines[ticker]
+                logging.debug("PortfolioStabilityTotal %s: %.3f, start = %.2f, finish = %.2f, yearly.declines = %.2f", ticker, self.scores[ticker], self.start[i], self.finish[i], self.yearlyDeclines[ticker])
+        return self.scores
 
     def printResults(self):
         print(f"\n\n** Metric - Portfolio Appreciation Stability Total Adjusted (PASTA) **\n")
         print(f"totalDays = {self.totalDays}")
         print(f"ignorePriceBelow = {self.ignorePriceBelow}")
         print(f"declinesWeight = {self.declinesWeight}\n")
-        for ticker in self.start:
-            if self.start[ticker] != 0:
-                self.declines[ticker] *= self.declinesWeight * 365/self.totalDays # trying to decrease effect of declines
-                self.scores[ticker] = self.finish[ticker] / self.start[ticker] - self.declines[ticker]
-                logging.debug(f"PortfolioStabilityTotal {ticker}: {self.scores[ticker]:.3f}, start = {self.start[ticker]:.2f}, finish = {self.finish[ticker]:.2f}, yearly.declines = {self.declines[ticker]:.2f}")
-        for place, ticker in zip(range(self.showTop), sorted(self.scores, key=self.scores.get, reverse=True)[:self.showTop]):
-            print(f"#{place+1:<3}: {ticker:<8} - {self.scores[ticker]:<6.3f}  = Growth {self.finish[ticker] / self.start[ticker]:<6.3f} - YearlyDeclines {self.declines[ticker]:.3f}")
+        self.calculate()
+        for place, ticker in enumerate(topTickers(self.scores, self.showTop)):
+            i = self.tickers.ids[ticker]
+            print(f"#{place+1:<3}: {ticker:<8} - {self.scores[ticker]:<6.3f}  = Growth {self.finish[i] / self.start[i]:<6.3f} - YearlyDeclines {self.yearlyDeclines[ticker]:.3f}")
         if "SPY.US" in self.scores:
-            print(f"#BENCHMARK SPY - {self.scores['SPY.US']:<6.3f}  = Growth {self.finish['SPY.US'] / self.start['SPY.US']:<6.3f} - YearlyDeclines {self.declines['SPY.US']:.3f}")
+            i = self.tickers.ids["SPY.US"]
+            print(f"#BENCHMARK SPY - {self.scores['SPY.US']:<6.3f}  = Growth {self.finish[i] / self.start[i]:<6.3f} - YearlyDeclines {self.yearlyDeclines['SPY.US']:.3f}")
 
 # Metric : largest difference between two trading(!) dates (startDate - endDate), used to find cheap stocks
-class MetricLargestDiffBetween():
+class MetricLargestDiffBetween(MetricState):
+    byDate = True # add() receives trading date instead of days ago
+    columns = {"start": ("d", math.nan), "end": ("d", math.nan), "priceNDaysBack": ("d", math.nan)}
+
     def __init__(self, *args, **kwds):
         self.startDate = kwds.pop("startDate", datetime.date.today()) # if startDate is before endDate then look for drops, otherwise for rises
         self.endDate = kwds.pop("endDate", datetime.date.today())     #
@@ -166,18 +662,64 @@ class MetricLargestDiffBetween():
         self.ignorePriceBelow = kwds.pop("ignorePriceBelow", 10) # exclude stocks that cost below X
         self.ignoreLeveragedETFs = kwds.pop("ignoreLeveragedETFs", True) # exclude leveraged ETFs
         self.showTop = kwds.pop("showTop", 20) # show top N winners
+        self.initState(kwds.pop("tickers", None))
         self.minDate = min(self.startDate, self.endDate)
         self.grewCoeff = 1.0 + self.grewMoreThanPercent/100
         self.nDaysBackFromStart = self.minDate + datetime.timedelta(days = -self.grewLongerThanDays) if self.grewLongerThanDays else None
-        self.scores, self.start, self.end, self.priceNDaysBack = {}, {}, {}, {}
+        self.scores = {}
+
+    # only prices on both dates and the last price before N days back are needed
+    def needs(self, endOrdinal):
+        dates = [self.startDate, self.endDate] + ([self.nDaysBackFromStart] if self.nDaysBackFromStart else [])
+        return stooqData.DataNeeds(ranges=[(date.toordinal(), date.toordinal()) for date in dates])
 
     def add(self, ticker, date, priceClose):
         if self.nDaysBackFromStart and date <= self.nDaysBackFromStart:
-            self.priceNDaysBack[ticker] = priceClose
+            self.priceNDaysBack[self.slot(ticker)] = priceClose
         elif date == self.startDate:
-            self.start[ticker] = priceClose
+            self.start[self.slot(ticker)] = priceClose
         elif date == self.endDate:
-            self.end[ticker] = priceClose
+            self.end[self.slot(ticker)] = priceClose
+
+    # vectorized version of add() for all days of ticker at once: last prices on or before the dates of interest
+    def addSeries(self, ticker, dates, closes, endOrdinal):
+        matching = np.ones(len(dates), dtype=bool)
+        if self.nDaysBackFromStart:
+            back = dates <= self.nDaysBackFromStart.toordinal()
+            if back.any():
+                self.priceNDaysBack[self.slot(ticker)] = float(closes[back][-1])
+            matching = ~back
+        for date, prices in ((self.startDate, self.start), (self.endDate, self.end)):
+            hits = matching & (dates == date.toordinal())
+            if hits.any():
+                prices[self.slot(ticker)] = float(closes[hits][-1])
+            matching = matching & ~hits
+
+    # sweep version of addSeries(), only a few days are looked at anyway
+    def addTables(self, ticker, tables):
+        self.addSeries(ticker, tables.dates, tables.closes, tables.endOrdinal)
+
+    # dates are fixed, so days never leave it
+    def windows(self):
+        return []
+
+    def shift(self, days):
+        pass
+
+    # calculate scores of all tickers from collected data
+    def calculate(self):
+        self.scores = {}
+        drops = (self.startDate < self.endDate)
+        for i in self.present("start"):
+            ticker, start, end = self.tickers.names[i], self.start[i], self.end[i]
+            if end == end and (ticker == "SPY.US" or \
+            start >= self.ignorePriceBelow and \
+            end >= self.ignorePriceBelow and \
+            (self.ignoreLeveragedETFs == False or ticker.split('.')[0] not in leveragedETFs) and \
+            (self.nDaysBackFromStart == None or (start if drops else end)/valueOr(self.priceNDaysBack[i], sys.maxsize) >= self.grewCoeff)):
+                self.scores[ticker] = 100*(start / end - 1)
+                logging.debug("LargestDiffBetween %s: %.3f, start = %.2f, end = %.2f, priceNDaysBack = %s", ticker, self.scores[ticker], start, end, valueOr(self.priceNDaysBack[i], -1))
+        return self.scores
 
     def printResults(self):
         print(f"\n\n** Metric - Largest % Difference Between Two Dates **\n")
@@ -187,28 +729,28 @@ class MetricLargestDiffBetween():
         print(f"grewMoreThanPercent = {self.grewMoreThanPercent}")
         print(f"ignoreLeveragedETFs = {self.ignoreLeveragedETFs}")
         print(f"ignorePriceBelow = {self.ignorePriceBelow}\n")
-        drops = (self.startDate < self.endDate)
-        for ticker in self.start:
-            if ticker in self.end and (ticker == "SPY.US" or \
-            self.start[ticker] >= self.ignorePriceBelow and \
-            self.end[ticker] >= self.ignorePriceBelow and \
-            (self.ignoreLeveragedETFs == False or ticker.split('.')[0] not in leveragedETFs) and \
-            (self.nDaysBackFromStart == None or (self.start[ticker] if drops else self.end[ticker])/self.priceNDaysBack.get(ticker, sys.maxsize) >= self.grewCoeff)):
-                self.scores[ticker] = 100*(self.start[ticker] / self.end[ticker] - 1)
-                logging.debug(f"LargestDiffBetween {ticker}: {self.scores[ticker]:.3f}, start = {self.start[ticker]:.2f}, end = {self.end[ticker]:.2f}, priceNDaysBack = {self.priceNDaysBack.get(ticker, -1)}")
-        for place, ticker in zip(range(self.showTop), sorted(self.scores, key=self.scores.get, reverse=True)[:self.showTop]):
-            print(f"#{place+1:<3}: {ticker:<8} - {self.scores[ticker]:<6.3f}  = {self.start[ticker]:<6.3f} > {self.end[ticker]:<6.3f}")
+        self.calculate()
+        for place, ticker in enumerate(topTickers(self.scores, self.showTop)):
+            i = self.tickers.ids[ticker]
+            print(f"#{place+1:<3}: {ticker:<8} - {self.scores[ticker]:<6.3f}  = {self.start[i]:<6.3f} > {self.end[i]:<6.3f}")
         if "SPY.US" in self.scores:
-            print(f"#BENCHMARK SPY - {self.scores['SPY.US']:<6.3f}  = {self.start['SPY.US']:<6.3f} > {self.end['SPY.US']:<6.3f}")
-            
+            i = self.tickers.ids["SPY.US"]
+            print(f"#BENCHMARK SPY - {self.scores['SPY.US']:<6.3f}  = {self.start[i]:<6.3f} > {self.end[i]:<6.3f}")
+
 # Metric : min/max/average price of particular stock between the dates
 class MetricMinMaxAvgPriceBetween():
+    byDate = True # add() receives trading date instead of days ago
+
     def __init__(self, *args, **kwds):
         self.startDate = kwds.pop("startDate", datetime.date.today()) # if startDate should be before endDate
         self.endDate = kwds.pop("endDate", datetime.date.today())     #
         self.ticker = kwds.pop("ticker", "FB.US")
         self.average, self.count, self.max, self.min = 0, 0, 0, sys.maxsize
 
+    # only one ticker between the dates is needed
+    def needs(self, endOrdinal):
+        return stooqData.DataNeeds(tickers=[self.ticker], ranges=[(self.startDate.toordinal(), self.endDate.toordinal())])
+
     def add(self, ticker, date, priceClose):
         if ticker == self.ticker and date >= self.startDate and date <= self.endDate:
             self.average += priceClose
@@ -216,98 +758,389 @@ class MetricMinMaxAvgPriceBetween():
             self.min = min(self.min, priceClose)
             self.max = max(self.max, priceClose)
 
+    # vectorized version of add() for all days of ticker at once
+    def addSeries(self, ticker, dates, closes, endOrdinal):
+        if ticker != self.ticker: return
+        prices = closes[(dates >= self.startDate.toordinal()) & (dates <= self.endDate.toordinal())]
+        if not len(prices): return
+        self.average += float(prices.sum())
+        self.count += len(prices)
+        self.min = min(self.min, float(prices.min()))
+        self.max = max(self.max, float(prices.max()))
+
+    # sweep version of addSeries(), only a few days are looked at anyway
+    def addTables(self, ticker, tables):
+        self.addSeries(ticker, tables.dates, tables.closes, tables.endOrdinal)
+
+    # dates are fixed, so days never leave it
+    def windows(self):
+        return []
+
+    def shift(self, days):
+        pass
+
+    def forget(self, ticker):
+        if ticker == self.ticker:
+            self.average, self.count, self.max, self.min = 0, 0, 0, sys.maxsize
+
+    # merge partial state collected by another process from different tickers
+    def merge(self, other):
+        self.average += other.average
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    # calculate statistics of the ticker from collected data, self.average holds sum of prices until then
+    def calculate(self):
+        self.scores = {"min": self.min, "max": self.max, "average": self.average/self.count if self.count > 0 else self.average, "count": self.count}
+        return self.scores
+
     def printResults(self):
         print(f"\n\n** Metric - Min / Max / Average Between Two Dates **\n")
         print(f"startDate = {self.startDate}")
         print(f"endDate = {self.endDate}")
         print(f"ticker = {self.ticker}")
-        if self.count > 0:
-            self.average = self.average/self.count
-        print(f"# Minimum: {self.min:<6.2f}")
-        print(f"# Maximum: {self.max:<6.2f}")
-        print(f"# Average: {self.average:<6.2f} over {self.count} trading days")
+        self.calculate()
+        print(f"# Minimum: {self.scores['min']:<6.2f}")
+        print(f"# Maximum: {self.scores['max']:<6.2f}")
+        print(f"# Average: {self.scores['average']:<6.2f} over {self.scores['count']} trading days")
             
+# Database end date is the latest date in the manifest
+def detectEndDate(entries):
+    lastDates = [entry["last"] for entry in entries if entry["rows"]]
+    return datetime.date.fromordinal(max(lastDates)) if lastDates else None
+
+# Feed every day of ticker prices to metrics
+def feedMetrics(metrics, ticker, dates, closes, endOrdinal):
+    byDate = any(metric.byDate for metric in metrics)
+    for ordinal, priceClose in zip(dates, closes):
+        daysAgo = endOrdinal - ordinal
+        date = datetime.date.fromordinal(ordinal) if byDate else None
+        for metric in metrics:
+            metric.add(ticker, date if metric.byDate else daysAgo, priceClose)
+    return len(dates)
+
+# Feed all days of ticker prices to metrics at once as NumPy arrays, the same result as feedMetrics() but much faster
+def feedSeries(metrics, ticker, dates, closes, endOrdinal):
+    if not len(dates): return 0
+    dates, closes = np.frombuffer(dates, dtype=np.intc), np.frombuffer(closes, dtype=np.float64)
+    for metric in metrics:
+        metric.addSeries(ticker, dates, closes, endOrdinal)
+    return len(dates)
+
+# Feed all days of ticker prices to metrics through precomputed tables, many configurations of the same metric share them
+def feedTables(metrics, ticker, dates, closes, endOrdinal):
+    if not len(dates): return 0
+    tables = SeriesTables(np.frombuffer(dates, dtype=np.intc), np.frombuffer(closes, dtype=np.float64), endOrdinal)
+    for metric in metrics:
+        metric.addTables(ticker, tables)
+    return len(dates)
+
+def showProgress(fileCounter, totalFiles):
+    sys.stdout.write('\rProcessing #' + str(fileCounter) + ' - ' + str(int(100*fileCounter/totalFiles)) + '% ...')
+
+# Scan database entries and feed their prices to metrics, returns number of processed days
+def scanEntries(source, entries, metrics, endOrdinal, vectorized=False, progress=None, ranges=None, feed=None):
+    feed = feed or (feedSeries if vectorized else feedMetrics)
+    processedDays = 0
+    if hasattr(source, "prefetch"): # members of zip are decompressed ahead in threads
+        source.prefetch(entries)
+    for fileCounter, entry in enumerate(entries, 1):
+        if progress: progress(fileCounter)
+        ticker = entry["ticker"]
+        try:
+            ticker, dates, closes = source.series(entry, ranges)
+            processedDays += feed(metrics, ticker, dates, closes, endOrdinal)
+        except (OSError, stooqData.StooqFormatError) as error:
+            print(f"Skipping {ticker}: {error}")
+    return processedDays
+
+# Scan database with row-at-a-time, vectorized and table-based metrics and compare their scores, returns number of mismatches
+def checkVectorized(source, entries, metrics, endOrdinal):
+    variants = [("vectorized", feedSeries, copy.deepcopy(metrics)), ("tables", feedTables, copy.deepcopy(metrics))]
+    scanEntries(source, entries, metrics, endOrdinal)
+    mismatches = 0
+    for name, feed, variantMetrics in variants:
+        scanEntries(source, entries, variantMetrics, endOrdinal, feed=feed)
+        for metric, variantMetric in zip(metrics, variantMetrics):
+            scores, variantScores = metric.calculate(), variantMetric.calculate()
+            for key in scores.keys() | variantScores.keys():
+                if key not in scores or key not in variantScores or not math.isclose(scores[key], variantScores[key], rel_tol=1e-9, abs_tol=1e-12):
+                    print(f"{type(metric).__name__} {name} mismatch for {key}: {scores.get(key)} != {variantScores.get(key)}")
+                    mismatches += 1
+            print(f"{type(metric).__name__}: {len(scores)} {name} scores compared")
+    return mismatches
+
+# Database source is opened once per worker process instead of being sent with every chunk
+workerSource = None
+
+def initWorker(source):
+    global workerSource
+    workerSource = source
+
+def scanChunk(entries, metrics, endOrdinal, vectorized, ranges, feed):
+    return metrics, scanEntries(workerSource, entries, metrics, endOrdinal, vectorized, ranges=ranges, feed=feed)
+
+# Split entries into contiguous chunks and scan them in process pool, every worker fills its own copy of metrics
+# that are merged back in original order of entries, so results are the same as in single process run
+def scanParallel(source, entries, metrics, endOrdinal, workers, vectorized=False, ranges=None, feed=None):
+    chunkSize = max(1, -(-len(entries) // (workers*8))) # several chunks per worker to balance uneven file sizes
+    chunks = [entries[i:i+chunkSize] for i in range(0, len(entries), chunkSize)]
+    results, processedDays, doneFiles = [None]*len(chunks), 0, 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(source,)) as pool:
+        futures = {pool.submit(scanChunk, chunk, metrics, endOrdinal, vectorized, ranges, feed): i for i, chunk in enumerate(chunks)}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+            doneFiles += len(chunks[futures[future]])
+            showProgress(doneFiles, len(entries))
+    for partialMetrics, partialDays in results:
+        for metric, partial in zip(metrics, partialMetrics):
+            metric.merge(partial)
+        processedDays += partialDays
+    return processedDays
+
+# Checkpoint of incremental mode: metrics with their accumulators, end date and the last processed day of every ticker.
+# Configuration is pickled metrics before the scan, checkpoint of differently configured metrics is not used
+CHECKPOINT_VERSION = 1
+
+def loadCheckpoint(stateFile, configuration):
+    try:
+        with open(stateFile, "rb") as fileIn:
+            checkpoint = pickle.load(fileIn)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+        return None
+    if checkpoint.get("version") != CHECKPOINT_VERSION or checkpoint.get("configuration") != configuration:
+        return None
+    return checkpoint
+
+def saveCheckpoint(stateFile, configuration, endOrdinal, entries, metrics):
+    tickers = {entry["path"]: {name: entry[name] for name in ("ticker", "first", "last", "size", "mtime")} for entry in entries}
+    with open(stateFile + ".tmp", "wb") as fileOut:
+        pickle.dump({"version": CHECKPOINT_VERSION, "configuration": configuration, "endOrdinal": endOrdinal, "tickers": tickers, "metrics": metrics}, fileOut)
+    os.replace(stateFile + ".tmp", stateFile)
+
+# Days of ticker that crossed threshold of days ago when end date moved from oldEnd to newEnd and days that follow them
+# within the threshold, both as lists of pairs (daysAgo, priceClose) relative to newEnd. Following days are all days within
+# FOLLOWING_DAYS, or at least the first one, days appended after lastOrdinal are not included since metrics haven't seen them
+def crossedDays(source, entry, threshold, oldEnd, newEnd, lastOrdinal):
+    fromOrdinal, toOrdinal = oldEnd - threshold, newEnd - threshold
+    ticker, dates, closes = source.series(entry, [(fromOrdinal, min(toOrdinal + FOLLOWING_DAYS, lastOrdinal))])
+    if lastOrdinal > toOrdinal + FOLLOWING_DAYS and (not len(dates) or dates[-1] < toOrdinal):
+        ticker, dates, closes = source.series(entry, [(fromOrdinal, lastOrdinal)])
+    crossed, following = [], []
+    for ordinal, priceClose in zip(dates, closes):
+        if ordinal < fromOrdinal: continue # the day before range
+        (crossed if ordinal < toOrdinal else following).append((newEnd - ordinal, priceClose))
+    return crossed, following
+
+# Update metrics restored from checkpoint: feed only days appended since the last run and let metrics drop days that left
+# their windows when end date moved forward. Tickers that metric can't update this way are calculated again from scratch
+def scanIncremental(source, entries, metrics, checkpoint, endOrdinal, vectorized=False, progress=None, ranges=None):
+    feed = feedSeries if vectorized else feedMetrics
+    oldEnd, known = checkpoint["endOrdinal"], checkpoint["tickers"]
+    for metric in metrics:
+        metric.shift(endOrdinal - oldEnd)
+    current = {entry["path"] for entry in entries}
+    for path, state in known.items():
+        if path not in current: # removed from database
+            for metric in metrics:
+                metric.forget(state["ticker"])
+
+    processedDays = 0
+    for fileCounter, entry in enumerate(entries, 1):
+        if progress: progress(fileCounter)
+        ticker, state = entry["ticker"], known.get(entry["path"])
+        try:
+            if state is None or state["last"] is None or state["first"] != entry["first"] or (entry["last"] or 0) < state["last"]:
+                recompute = metrics # new or rewritten file
+            else:
+                recompute, crossings = [], {}
+                for metric in metrics:
+                    for threshold in metric.windows() if endOrdinal > oldEnd else []:
+                        if threshold not in crossings:
+                            crossings[threshold] = crossedDays(source, entry, threshold, oldEnd, endOrdinal, state["last"])
+                        if not metric.expire(ticker, threshold, *crossings[threshold]):
+                            recompute.append(metric) # metric can't drop the days
+                            break
+                if entry["size"] != state["size"] or entry["mtime"] != state["mtime"]: # days were appended
+                    updated = [metric for metric in metrics if metric not in recompute]
+                    ticker, dates, closes = source.series(entry, [(state["last"] + 1, None)])
+                    first = bisect.bisect_right(dates, state["last"])
+                    processedDays += feed(updated, ticker, dates[first:], closes[first:], endOrdinal)
+            if recompute:
+                for metric in recompute:
+                    metric.forget(ticker)
+                ticker, dates, closes = source.series(entry, ranges)
+                processedDays += feed(recompute, ticker, dates, closes, endOrdinal)
+        except (OSError, stooqData.StooqFormatError) as error:
+            print(f"Skipping {ticker}: {error}")
+    return processedDays
+
+# Metric classes by name for sweep grids
+METRICS = {metric.__name__: metric for metric in (MetricRecentPeakRatio, MetricPortfolioTrendlineAngle, MetricPortfolioStabilityPeak,
+                                                  MetricPortfolioStabilityTotal, MetricLargestDiffBetween, MetricMinMaxAvgPriceBetween)}
+
+# Constructor parameters of every metric with JSON types of their values, dates are strings like "2020-02-19"
+METRIC_PARAMETERS = {
+    "MetricRecentPeakRatio": {"totalDays": "integer", "peakedPastDays": "integer", "showTop": "integer"},
+    "MetricPortfolioTrendlineAngle": {"totalDays": "integer", "origInvestment": "number", "showTop": "integer"},
+    "MetricPortfolioStabilityPeak": {"totalDays": "integer", "ignorePriceBelow": "number", "showTop": "integer"},
+    "MetricPortfolioStabilityTotal": {"totalDays": "integer", "ignorePriceBelow": "number", "declinesWeight": "number", "showTop": "integer"},
+    "MetricLargestDiffBetween": {"startDate": "string", "endDate": "string", "grewLongerThanDays": "integer or null", "grewMoreThanPercent": "number",
+                                 "ignorePriceBelow": "number", "ignoreLeveragedETFs": "boolean", "showTop": "integer"},
+    "MetricMinMaxAvgPriceBetween": {"startDate": "string", "endDate": "string", "ticker": "string"},
+}
+JSON_TYPES = {"integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+              "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+              "string": lambda value: isinstance(value, str),
+              "boolean": lambda value: isinstance(value, bool),
+              "integer or null": lambda value: value is None or isinstance(value, int) and not isinstance(value, bool)}
+
+# Raises ValueError for parameter that metric doesn't have or for value of wrong type, constructors ignore unknown parameters
+def checkParameters(className, parameters):
+    known = METRIC_PARAMETERS[className]
+    for name, value in parameters.items():
+        if name not in known:
+            raise ValueError(f"unknown parameter {name}, expected one of {', '.join(known)}")
+        if not JSON_TYPES[known[name]](value):
+            raise ValueError(f"{name} must be {known[name]}, not {json.dumps(value)}")
+
+# Constructor parameters of metric from JSON values, values of parameters ending with "Date" are dates like "2020-02-19"
+def metricConfiguration(parameters):
+    return {name: datetime.date.fromisoformat(value) if name.endswith("Date") else value for name, value in parameters.items()}
+
+# Metrics for every combination of parameters in sweep grid, grid file is JSON object of metric class names with lists of
+# constructor parameter values, for example {"MetricRecentPeakRatio": {"totalDays": [365, 1825], "peakedPastDays": [1, 10]}},
+# single value is the same as list of one value
+def loadSweep(gridFile, showTop):
+    with open(gridFile) as fileIn:
+        grid = json.load(fileIn)
+    metrics = []
+    for className, parameters in grid.items():
+        if className not in METRICS:
+            raise ValueError(f"unknown metric {className}, expected one of {', '.join(METRICS)}")
+        names = list(parameters)
+        values = [value if isinstance(value, list) else [value] for value in parameters.values()]
+        for combination in itertools.product(*values):
+            configuration = metricConfiguration(dict(zip(names, combination)))
+            metric = METRICS[className](**configuration, showTop=showTop)
+            metric.sweepParameters = configuration
+            metrics.append(metric)
+    return metrics
+
+# Table of top N winners of every configuration in sweep
+def printSweep(metrics):
+    for className in dict.fromkeys(type(metric).__name__ for metric in metrics):
+        configurations = [metric for metric in metrics if type(metric).__name__ == className]
+        print(f"\n\n** Sweep - {className}: {len(configurations)} configurations **\n")
+        for metric in configurations:
+            scores = metric.calculate()
+            print(", ".join(f"{name} = {value}" for name, value in metric.sweepParameters.items()))
+            if not hasattr(metric, "showTop"): # statistics of one ticker instead of winners
+                print("  " + ", ".join(f"{name} = {int(value)}" if name == "count" else f"{name} = {value:.2f}" for name, value in scores.items()))
+                continue
+            for place, ticker in enumerate(topTickers(scores, metric.showTop)):
+                print(f"  #{place+1:<3}: {ticker:<8} - {scores[ticker]:.3f}")
+
 # MAIN
-if len(sys.argv) < 2:
-    print("\nUsage: " + os.path.basename(sys.argv[0]) + " <InputFolder>\n")
-    print("Example: " + os.path.basename(sys.argv[0]) + " daily")
-    exit()
-
-# Variables
-fileCounter = 0
-totalFiles = 0
-processedDays = 0
-endDate = None
-folderIn = sys.argv[1]
-procStart = datetime.datetime.now()
-
-# Metrics
-metric1 = MetricRecentPeakRatio(totalDays = 5*365, peakedPastDays = 1, showTop = 20)
-metric2 = MetricPortfolioTrendlineAngle(totalDays = 5*365, origInvestment = 10000, showTop = 20)
-metric3 = MetricPortfolioStabilityPeak(totalDays = 13*365, ignorePriceBelow = 5, showTop = 20)
-metric4 = MetricPortfolioStabilityTotal(totalDays = 13*365, ignorePriceBelow = 5, declinesWeight = 5, showTop = 20)
-metric5 = MetricLargestDiffBetween(startDate = datetime.date(2020, 2, 19), \
-                                   endDate = datetime.date(2020, 6, 8), \
-                                   grewLongerThanDays = 1*365, \
-                                   grewMoreThanPercent = 20, \
-                                   ignoreLeveragedETFs = True, \
-                                   ignorePriceBelow = 15, \
-                                   showTop = 40)
-metric6 = MetricMinMaxAvgPriceBetween(startDate = datetime.date(2021, 4, 1), \
-                                      endDate = datetime.date(2021, 4, 30), \
-                                      ticker = "FB.US")
-
-# Determine total amount of files and database end date
-for path, subdirs, files in os.walk(folderIn):
-    totalFiles += len(files)
-    for file in files:
-        if not endDate:
-            # Read contents of file with prices
-            with open(path + "\\" + file, "r") as fileIn:
-                for line in fileIn:
-                    if line[0] == '<': continue # skip the header that starts with "<TICKER>"
-                    sdate = line.split(",")[2]
-                    endDate = datetime.date(int(sdate[:4]), int(sdate[4:6]), int(sdate[6:8])) # fast date parser
-
-print(f"\nStocks/ETFs in the database: {totalFiles}")
-if endDate: print(f"Detected End Date: {endDate:%Y-%m-%d}\n")
-
-# Walk through Stooq database folder structure
-for path, subdirs, files in os.walk(folderIn):
-    # Every file is a stock or ETF
-    for file in files:
-        fileCounter += 1
-        sys.stdout.write('\rProcessing #' + str(fileCounter) + ' - ' + str(int(100*fileCounter/totalFiles)) + '% ...')
-        (name, ext) = os.path.splitext(file) # extract stock name/ticker
-        ticker = name.upper()
+def main():
+    parser = argparse.ArgumentParser(description="Scan Stooq.com database of daily stocks/ETFs prices and calculate winner stocks by certain metrics")
+    parser.add_argument("database", help="folder with Stooq database, downloaded zip of it or its compiled cache, for example 'daily' or 'd_us_txt.zip'")
+    parser.add_argument("--compile", metavar="CACHEDIR", help="compile database folder or zip into columnar binary cache (only changed files are parsed again) and scan the cache")
+    parser.add_argument("--no-refresh", action="store_true", help="use manifest of database folder or zip as is without checking files for changes")
+    parser.add_argument("--only", action="append", metavar="FILTER", help="scan only ticker (like FB.US) or exchange subfolder (like 'nyse etfs'), can be repeated, other members of zip are not even decompressed")
+    parser.add_argument("--threads", type=int, default=4, metavar="N", help="decompress members of zip database in N threads (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1, metavar="N", help="scan database in N processes, results are the same as in single process run")
+    parser.add_argument("--vectorized", action="store_true", help="calculate metrics on whole price series with NumPy instead of day by day")
+    parser.add_argument("--check", action="store_true", help="calculate all metrics both day by day and vectorized and compare the scores")
+    parser.add_argument("--incremental", metavar="STATEFILE", help="save metrics to checkpoint after the run and update them next time only with days added since then")
+    parser.add_argument("--sweep", metavar="GRIDFILE", help="calculate every combination of metric parameters from JSON grid file in one pass and show top N of each")
+    parser.add_argument("--top", type=int, default=10, metavar="N", help="number of winners shown for every configuration in sweep mode (default: %(default)s)")
+    parser.add_argument("--debug", action="store_true", help="write details of scores of every ticker to debug.log")
+    args = parser.parse_args()
+    if args.debug: # debug messages are not even formatted otherwise
+        logging.basicConfig(filename="debug.log", filemode='a', format='%(asctime)s %(levelname)s %(funcName)s() - %(message)s', level=logging.DEBUG)
+    if (args.vectorized or args.check or args.sweep) and np is None:
+        parser.error("NumPy is required for vectorized metrics")
+
+    # Variables
+    procStart = datetime.datetime.now()
+
+    # Metrics
+    metric1 = MetricRecentPeakRatio(totalDays = 5*365, peakedPastDays = 1, showTop = 20)
+    metric2 = MetricPortfolioTrendlineAngle(totalDays = 5*365, origInvestment = 10000, showTop = 20)
+    metric3 = MetricPortfolioStabilityPeak(totalDays = 13*365, ignorePriceBelow = 5, showTop = 20)
+    metric4 = MetricPortfolioStabilityTotal(totalDays = 13*365, ignorePriceBelow = 5, declinesWeight = 5, showTop = 20)
+    metric5 = MetricLargestDiffBetween(startDate = datetime.date(2020, 2, 19), \
+                                       endDate = datetime.date(2020, 6, 8), \
+                                       grewLongerThanDays = 1*365, \
+                                       grewMoreThanPercent = 20, \
+                                       ignoreLeveragedETFs = True, \
+                                       ignorePriceBelow = 15, \
+                                       showTop = 40)
+    metric6 = MetricMinMaxAvgPriceBetween(startDate = datetime.date(2021, 4, 1), \
+                                          endDate = datetime.date(2021, 4, 30), \
+                                          ticker = "FB.US")
+    metrics = [metric6] # active metrics, add metric1 ... metric5 to calculate them as well
+    if args.sweep:
         try:
-            # Read contents of file with prices
-            with open(path + "\\" + file, "r") as fileIn:
-                for line in fileIn:
-                    if line[0] == '<': continue # skip the header that starts with "<TICKER>"
-                    (ticker,period,sdate,stime,sopen,shigh,slow,sclose,svolume,sopenint) = line.split(",") # parsing the day line
-                    processedDays += 1
-                    
-                    date = datetime.date(int(sdate[:4]), int(sdate[4:6]), int(sdate[6:8])) # fast date parser
-                    daysAgo = (endDate - date).days
-                    priceClose = float(sclose)
-                    
-                    #metric1.add(ticker, daysAgo, priceClose)
-                    #metric2.add(ticker, daysAgo, priceClose)
-                    #metric3.add(ticker, daysAgo, priceClose)
-                    #metric4.add(ticker, daysAgo, priceClose)
-                    #metric5.add(ticker, date, priceClose)
-                    metric6.add(ticker, date, priceClose)
-
-        except KeyboardInterrupt: raise
-        except: print(f"Exception when processing {ticker}: {traceback.format_exc()}")
-
-#metric1.printResults()
-#metric2.printResults()
-#metric3.printResults()
-#metric4.printResults()
-#metric5.printResults()
-metric6.printResults()
-timeElapsed = datetime.datetime.now() - procStart
-print(f"\nTotal days processed: {processedDays}")
-print(f"Time Elapsed: {timeElapsed.total_seconds():.2f} sec")
+            metrics = loadSweep(args.sweep, args.top)
+        except (OSError, ValueError, TypeError) as error:
+            parser.error(f"can't load sweep grid {args.sweep}: {error}")
+
+    # Compile text database into binary cache once, following runs can use the cache directly
+    if args.compile:
+        print(f"\nCompiling {args.database} into {args.compile} ...")
+        parsed, reused = stooqData.compileDatabase(args.database, args.compile, showProgress)
+        print(f"\nParsed {parsed} files, reused {reused} unchanged files from previous cache")
+        args.database = args.compile
+
+    # Determine total amount of files, days and database end date from manifest (or cache index)
+    source = stooqData.openSource(args.database, refresh=not args.no_refresh, include=args.only, threads=args.threads)
+    entries = [entry for entry in source.entries() if stooqData.included(entry["path"], entry["ticker"], args.only)]
+    totalFiles = len(entries)
+    endDate = detectEndDate(entries)
+    if not endDate:
+        print(f"\nNo prices found in {args.database}")
+        return
+
+    print(f"\nStocks/ETFs in the database: {totalFiles}")
+    print(f"Days in the database: {sum(entry['rows'] for entry in entries)}")
+    print(f"Detected End Date: {endDate:%Y-%m-%d}\n")
+
+    if args.check:
+        mismatches = checkVectorized(source, entries, metrics if args.sweep else [metric1, metric2, metric3, metric4, metric5, metric6], endDate.toordinal())
+        print(f"\n{mismatches} mismatches between row-at-a-time, vectorized and table-based metrics")
+        sys.exit(1 if mismatches else 0)
+
+    # Skip files and days that no active metric needs
+    needs = stooqData.DataNeeds.combine(metric.needs(endDate.toordinal()) for metric in metrics)
+    entries = [entry for entry in entries if needs.wants(entry["ticker"])]
+    if len(entries) < totalFiles: print(f"Stocks/ETFs needed by metrics: {len(entries)}\n")
+
+    # Every entry is a stock or ETF, configurations of sweep share tables precomputed once per ticker
+    feed = feedTables if args.sweep else None
+    configuration = pickle.dumps(metrics)
+    checkpoint = loadCheckpoint(args.incremental, configuration) if args.incremental else None
+    if checkpoint and checkpoint["endOrdinal"] <= endDate.toordinal():
+        print(f"Updating metrics since {datetime.date.fromordinal(checkpoint['endOrdinal']):%Y-%m-%d} from {args.incremental}\n")
+        metrics = checkpoint["metrics"]
+        processedDays = scanIncremental(source, entries, metrics, checkpoint, endDate.toordinal(), args.vectorized, lambda fileCounter: showProgress(fileCounter, len(entries)), needs.ranges)
+    elif args.workers > 1:
+        processedDays = scanParallel(source, entries, metrics, endDate.toordinal(), args.workers, args.vectorized, needs.ranges, feed)
+    else:
+        processedDays = scanEntries(source, entries, metrics, endDate.toordinal(), args.vectorized, lambda fileCounter: showProgress(fileCounter, len(entries)), needs.ranges, feed)
+    if args.incremental:
+        saveCheckpoint(args.incremental, configuration, endDate.toordinal(), entries, metrics)
+
+    if args.sweep:
+        printSweep(metrics)
+    else:
+        for metric in metrics:
+            metric.printResults()
+    timeElapsed = datetime.datetime.now() - procStart
+    print(f"\nTotal days processed: {processedDays}")
+    print(f"Time Elapsed: {timeElapsed.total_seconds():.2f} sec")
+
+if __name__ == "__main__":
+    main()
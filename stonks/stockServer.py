@@ -0,0 +1,271 @@
+# Resident query server of stockDigger: loads Stooq.com database into memory once and answers metric queries over HTTP
+# on local port or Unix socket, results are cached by metric, its parameters and fingerprint of the database files
+#
+# Query is JSON object (or list of them) posted to /query, for example
+#   curl -d '{"metric": "MetricMinMaxAvgPriceBetween", "parameters": {"ticker": "FB.US", "startDate": "2021-04-01", "endDate": "2021-04-30"}}' localhost:8020/query
+# or the same as GET /query?metric=MetricMinMaxAvgPriceBetween&ticker=FB.US&startDate=2021-04-01&endDate=2021-04-30,
+# GET /status shows the database and the cache
+# AG @ 2020
+import os
+import sys
+import json
+import time
+import array
+import signal
+import hashlib
+import argparse
+import datetime
+import collections
+import http.server
+import socketserver
+import urllib.parse
+import stooqData
+import stockDigger
+
+# Fingerprint of database is hash of path, size and modification time of every file, it changes with any file
+def databaseFingerprint(entries):
+    files = sorted((entry["path"], entry["size"], entry["mtime"]) for entry in entries)
+    return hashlib.sha1(json.dumps(files).encode()).hexdigest()[:16]
+
+# Copy of typed array or memory view, so prices stay valid after memory map of cache is closed
+def copied(typecode, values):
+    copy = array.array(typecode)
+    copy.frombytes(memoryview(values).tobytes())
+    return copy
+
+# Close prices of all tickers kept in memory, files are checked for changes at most every refreshInterval seconds and
+# only added or changed files are read again
+class MemoryDatabase():
+    def __init__(self, path, refreshInterval=5.0):
+        self.path, self.refreshInterval = path, refreshInterval
+        self.entries, self.prices, self.fingerprint, self.endOrdinal, self.checked = [], {}, None, None, 0
+        self.refresh(force=True)
+
+    # returns True when database changed since last check
+    def refresh(self, force=False):
+        if not force and (self.refreshInterval < 0 or time.monotonic() - self.checked < self.refreshInterval):
+            return False
+        self.checked = time.monotonic()
+        source = stooqData.openSource(self.path)
+        entries = source.entries()
+        fingerprint = databaseFingerprint(entries)
+        if fingerprint == self.fingerprint:
+            return False
+        prices = {}
+        for entry in entries:
+            known = self.prices.get(entry["path"])
+            if known and known[0] == (entry["size"], entry["mtime"]):
+                prices[entry["path"]] = known # unchanged file
+                continue
+            ticker, dates, closes = source.series(entry)
+            prices[entry["path"]] = ((entry["size"], entry["mtime"]), ticker, copied('i', dates), copied('d', closes))
+        endDate = stockDigger.detectEndDate(entries)
+        self.entries, self.prices, self.fingerprint = entries, prices, fingerprint
+        self.endOrdinal = endDate.toordinal() if endDate else None
+        return True
+
+    # feed prices of tickers that metrics need to all of them at once, tables of every ticker are shared by the metrics
+    def scan(self, metrics):
+        needs = stooqData.DataNeeds.combine(metric.needs(self.endOrdinal) for metric in metrics)
+        feed = stockDigger.feedTables if stockDigger.np is not None else stockDigger.feedMetrics
+        processedDays = 0
+        for entry in self.entries:
+            if needs.wants(entry["ticker"]):
+                version, ticker, dates, closes = self.prices[entry["path"]]
+                processedDays += feed(metrics, ticker, dates, closes, self.endOrdinal)
+        return processedDays
+
+# Results of queries in LRU order, the least recently used are evicted when there are more than maxEntries of them or
+# their JSON takes more than maxBytes
+class ResultCache():
+    def __init__(self, maxEntries, maxBytes):
+        self.maxEntries, self.maxBytes = maxEntries, maxBytes
+        self.results, self.size = collections.OrderedDict(), 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, key):
+        if key not in self.results:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.results.move_to_end(key)
+        return self.results[key][0]
+
+    def put(self, key, result):
+        if key in self.results:
+            self.size -= self.results.pop(key)[1]
+        size = len(json.dumps(result))
+        self.results[key] = (result, size)
+        self.size += size
+        while self.results and (len(self.results) > self.maxEntries or self.size > self.maxBytes):
+            self.size -= self.results.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def clear(self):
+        self.results.clear()
+        self.size = 0
+
+# Result of calculated metric: top winners with their scores or statistics of one ticker
+def metricResult(metric):
+    scores = metric.calculate()
+    if not hasattr(metric, "showTop"):
+        return scores
+    return [[ticker, scores[ticker]] for ticker in stockDigger.topTickers(scores, metric.showTop)]
+
+class QueryError(ValueError):
+    pass
+
+# Answers of queries from the database in memory and the cache of results
+class QueryServer():
+    def __init__(self, database, cache, showTop):
+        self.database, self.cache, self.showTop = database, cache, showTop
+        self.queries, self.started = 0, datetime.datetime.now()
+
+    # cache key and metric of query {"metric": class name, "parameters": {constructor parameters}}
+    def parse(self, query):
+        if not isinstance(query, dict) or not isinstance(query.get("parameters", {}), dict):
+            raise QueryError("query must be object with metric name and parameters object")
+        className, parameters = query.get("metric"), dict(query.get("parameters", {}))
+        if className not in stockDigger.METRICS:
+            raise QueryError(f"unknown metric {className}, expected one of {', '.join(stockDigger.METRICS)}")
+        if "tickers" in parameters:
+            raise QueryError("tickers is not a metric parameter")
+        try:
+            stockDigger.checkParameters(className, parameters)
+        except ValueError as error:
+            raise QueryError(f"bad parameters of {className}: {error}")
+        if issubclass(stockDigger.METRICS[className], stockDigger.MetricState): # metrics of winners
+            parameters.setdefault("showTop", self.showTop)
+        try:
+            metric = stockDigger.METRICS[className](**stockDigger.metricConfiguration(parameters))
+        except (ValueError, TypeError) as error:
+            raise QueryError(f"bad parameters of {className}: {error}")
+        return (className, json.dumps(parameters, sort_keys=True), self.database.fingerprint), metric
+
+    # answers of list of queries, metrics of queries not found in cache are calculated together in one pass
+    def answer(self, queries):
+        start = time.perf_counter()
+        if self.database.refresh():
+            self.cache.clear() # results of previous files can't be asked for anymore
+        parsed = [self.parse(query) for query in queries]
+        results = [self.cache.get(key) for key, metric in parsed]
+        missing = {key: metric for (key, metric), result in zip(parsed, results) if result is None}
+        processedDays = self.database.scan(list(missing.values())) if missing else 0
+        calculated = {key: metricResult(metric) for key, metric in missing.items()}
+        for key, result in calculated.items():
+            self.cache.put(key, result)
+        self.queries += len(queries)
+        answers = [{"metric": key[0], "parameters": json.loads(key[1]), "cached": result is not None, "result": calculated.get(key, result)}
+                   for (key, metric), result in zip(parsed, results)]
+        return {"answers": answers, "endDate": self.endDate(), "fingerprint": self.database.fingerprint,
+                "processedDays": processedDays, "seconds": round(time.perf_counter() - start, 6)}
+
+    def endDate(self):
+        return datetime.date.fromordinal(self.database.endOrdinal).isoformat() if self.database.endOrdinal else None
+
+    def status(self):
+        cache = self.cache
+        return {"database": self.database.path, "tickers": len(self.database.entries), "endDate": self.endDate(),
+                "days": sum(entry["rows"] for entry in self.database.entries), "fingerprint": self.database.fingerprint,
+                "queries": self.queries, "started": f"{self.started:%Y-%m-%d %H:%M:%S}",
+                "cache": {"entries": len(cache.results), "bytes": cache.size, "hits": cache.hits, "misses": cache.misses, "evictions": cache.evictions}}
+
+# Value of GET query parameter: JSON number, boolean or null, otherwise string like date
+def queryValue(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    server_version = "stockServer/1"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/status":
+            self.reply(200, self.server.queries.status())
+        elif url.path == "/query":
+            parameters = dict(urllib.parse.parse_qsl(url.query))
+            metric = parameters.pop("metric", None)
+            types = stockDigger.METRIC_PARAMETERS.get(metric, {}) # string parameters stay strings, ticker can look like number
+            self.answer({"metric": metric, "parameters": {name: value if types.get(name) == "string" else queryValue(value) for name, value in parameters.items()}})
+        else:
+            self.reply(404, {"error": f"unknown path {url.path}, expected /query or /status"})
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path != "/query":
+            self.reply(404, {"error": "queries are posted to /query"})
+            return
+        try:
+            query = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError as error:
+            self.reply(400, {"error": f"query is not JSON: {error}"})
+            return
+        self.answer(query)
+
+    # one query gets one answer, list of queries gets list of answers
+    def answer(self, query):
+        try:
+            response = self.server.queries.answer(query if isinstance(query, list) else [query])
+        except QueryError as error:
+            self.reply(400, {"error": str(error)})
+            return
+        except (OSError, stooqData.StooqFormatError) as error:
+            self.reply(500, {"error": f"can't read database: {error}"})
+            return
+        if not isinstance(query, list):
+            response.update(response.pop("answers")[0])
+        self.reply(200, response)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # clients of Unix socket have no address
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address) # socket left by previous run
+        super().server_bind()
+
+# MAIN
+def main():
+    parser = argparse.ArgumentParser(description="Resident server that keeps Stooq.com database in memory and answers stockDigger metric queries over HTTP")
+    parser.add_argument("database", help="folder with Stooq database or its compiled cache, for example 'daily'")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8020, help="HTTP port to listen on (default: %(default)s)")
+    parser.add_argument("--socket", metavar="PATH", help="listen on Unix socket instead of port")
+    parser.add_argument("--refresh", type=float, default=5, metavar="SECONDS", help="check database files for changes before query at most every N seconds, negative never (default: %(default)s)")
+    parser.add_argument("--cache-entries", type=int, default=1000, metavar="N", help="maximum number of cached results (default: %(default)s)")
+    parser.add_argument("--cache-mb", type=float, default=64, metavar="MB", help="maximum size of cached results in MB (default: %(default)s)")
+    parser.add_argument("--top", type=int, default=20, metavar="N", help="number of winners of query without showTop parameter (default: %(default)s)")
+    args = parser.parse_args()
+
+    procStart = datetime.datetime.now()
+    database = MemoryDatabase(args.database, args.refresh)
+    queries = QueryServer(database, ResultCache(args.cache_entries, int(args.cache_mb * 1024 * 1024)), args.top)
+    status = queries.status()
+    print(f"Loaded {status['tickers']} Stocks/ETFs with {status['days']} days until {status['endDate']} in {(datetime.datetime.now() - procStart).total_seconds():.2f} sec")
+
+    server = UnixHTTPServer(args.socket, QueryHandler) if args.socket else http.server.HTTPServer((args.host, args.port), QueryHandler)
+    server.queries = queries
+    print(f"Listening on {args.socket or f'http://{args.host}:{args.port}'}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # stop the same way as Ctrl+C
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,565 @@
+# Access layer for Stooq.com database of daily stocks/ETFs prices: text folder reader, reader of downloaded zip and
+# compiled columnar cache
+# AG @ 2020
+import os
+import sys
+import json
+import mmap
+import zlib
+import bisect
+import zipfile
+import datetime
+import threading
+import concurrent.futures
+from array import array
+
+COLUMNS = ("open", "high", "low", "close", "volume") # price columns stored in the cache, date is stored separately
+CACHE_VERSION = 2
+CACHE_INDEX = "index.json"
+MANIFEST_VERSION = 1
+
+FIELDS = ("ticker", "per", "date", "time") + COLUMNS + ("openint",) # fields of every row of Stooq text file
+
+# Malformed Stooq text file, tells the file and the line (or byte offset when file was read from the middle) and what's wrong
+class StooqFormatError(ValueError):
+    def __init__(self, filePath, where, problem):
+        super().__init__(f"{filePath}, {where}: {problem}")
+        self.filePath, self.where, self.problem = filePath, where, problem
+
+# Lookup table of Stooq dates YYYYMMDD (as bytes) to date ordinals, filled with every date seen, so dates are parsed once
+dateOrdinals = {}
+
+# Parse contents of Stooq text file (or of its part that starts at a row) in bulk: the whole text is split into fields once
+# and only requested columns are converted into arrays, returns ticker, array of date ordinals and dictionary of arrays
+# firstLine is the number of the first line of data in the file or None if data was read from byte offset dataOffset
+def parseStooqBytes(data, columns=COLUMNS, filePath="<data>", firstLine=1, dataOffset=0):
+    if data.startswith(b"<"): # skip the header that starts with "<TICKER>"
+        header = data.find(b"\n") + 1 or len(data)
+        data, dataOffset, firstLine = data[header:], dataOffset + header, firstLine and firstLine + 1
+    if data.endswith(b"\n"): data = data[:-1] # "\r" of Windows line ends stays in the last field that is never converted
+    if not data: return None, array('i'), {column: array('d') for column in columns}
+
+    fields, rows = data.replace(b"\n", b",").split(b","), data.count(b"\n") + 1
+    if len(fields) != rows * len(FIELDS):
+        checkFieldCounts(data, filePath, firstLine, dataOffset)
+    stride = len(FIELDS)
+
+    dateFields = fields[FIELDS.index("date")::stride]
+    try:
+        dates = array('i', map(dateOrdinals.__getitem__, dateFields))
+    except KeyError:
+        for number, sdate in enumerate(dateFields):
+            if sdate not in dateOrdinals:
+                try:
+                    if len(sdate) != 8: raise ValueError(sdate)
+                    dateOrdinals[sdate] = stooqToOrdinal(sdate)
+                except ValueError:
+                    checkFieldCounts(data, filePath, firstLine, dataOffset) # line with extra field shifts the following ones
+                    raise StooqFormatError(filePath, where(data, number, firstLine, dataOffset), f"invalid date {sdate!r}") from None
+        dates = array('i', map(dateOrdinals.__getitem__, dateFields))
+
+    values = {}
+    for column in columns:
+        columnFields = fields[FIELDS.index(column)::stride]
+        try:
+            values[column] = array('d', map(float, columnFields))
+        except ValueError:
+            checkFieldCounts(data, filePath, firstLine, dataOffset)
+            number = next(number for number, value in enumerate(columnFields) if not isNumber(value))
+            raise StooqFormatError(filePath, where(data, number, firstLine, dataOffset), f"invalid {column} price {columnFields[number]!r}") from None
+    return fields[0].decode(), dates, values
+
+# Raises StooqFormatError for the first line that doesn't have all fields. Lines with extra and missing fields can add up
+# to the right total, so it's checked again before blaming a date or a price of shifted columns
+def checkFieldCounts(data, filePath, firstLine, dataOffset):
+    for number, line in enumerate(data.split(b"\n")):
+        if line.count(b",") != len(FIELDS) - 1:
+            raise StooqFormatError(filePath, where(data, number, firstLine, dataOffset), f"expected {len(FIELDS)} fields, got {line.count(b',') + 1} in {line[:80]!r}")
+
+def isNumber(value):
+    try: float(value)
+    except ValueError: return False
+    return True
+
+# Position of row number N of data for error messages: line number if it's known, byte offset of the row otherwise
+def where(data, number, firstLine, dataOffset):
+    if firstLine: return f"line {firstLine + number}"
+    offset = 0
+    for _ in range(number):
+        offset = data.index(b"\n", offset) + 1
+    return f"byte {dataOffset + offset}"
+
+# Parse one Stooq text file into ticker, array of date ordinals and dictionary of arrays of requested columns (OHLCV by default)
+def parseStooqFile(filePath, columns=COLUMNS):
+    with open(filePath, "rb") as fileIn:
+        return parseStooqBytes(fileIn.read(), columns, filePath)
+
+# Data that metric needs from database: set of tickers (None means all) and list of date ranges as pairs of ordinals
+# (fromOrdinal, toOrdinal) where None is an open end. Every range also includes the last day before its start,
+# so metrics can see the price "as of" that day and know that ticker has history older than the range
+class DataNeeds():
+    def __init__(self, tickers=None, ranges=None):
+        self.tickers = set(tickers) if tickers is not None else None
+        self.ranges = list(ranges) if ranges is not None else [(None, None)]
+
+    # combine needs of several metrics, overlapping ranges are joined together
+    @staticmethod
+    def combine(needs):
+        tickers, ranges = set(), []
+        for need in needs:
+            tickers = None if tickers is None or need.tickers is None else tickers | need.tickers
+            ranges.extend(need.ranges)
+        joined = []
+        for fromOrdinal, toOrdinal in sorted(ranges, key=lambda r: -sys.maxsize if r[0] is None else r[0]):
+            if joined and (joined[-1][1] is None or fromOrdinal is None or fromOrdinal <= joined[-1][1] + 1):
+                if joined[-1][1] is not None:
+                    joined[-1][1] = None if toOrdinal is None else max(joined[-1][1], toOrdinal)
+            else:
+                joined.append([fromOrdinal, toOrdinal])
+        return DataNeeds(tickers, [tuple(r) for r in joined])
+
+    def everything(self):
+        return self.ranges == [(None, None)]
+
+    def wants(self, ticker):
+        return self.tickers is None or ticker in self.tickers
+
+# Stooq date YYYYMMDD as integer, it keeps the order of dates so text files can be searched without parsing dates
+def ordinalToStooq(ordinal):
+    date = datetime.date.fromordinal(ordinal)
+    return date.year*10000 + date.month*100 + date.day
+
+def stooqToOrdinal(sdate):
+    return datetime.date(int(sdate[:4]), int(sdate[4:6]), int(sdate[6:8])).toordinal() # fast date parser
+
+# Byte offset of the first line that starts at or after given offset
+def nextLineStart(fileIn, offset, dataStart):
+    if offset <= dataStart:
+        fileIn.seek(dataStart)
+        return dataStart
+    fileIn.seek(offset - 1)
+    fileIn.readline()
+    return fileIn.tell()
+
+# Byte offset of the first line with date not earlier than yyyymmdd, binary search over bytes since Stooq files are sorted by date
+def seekDate(fileIn, yyyymmdd, dataStart, size):
+    lo, hi = dataStart, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        lineStart = nextLineStart(fileIn, mid, dataStart)
+        line = fileIn.readline() if lineStart < size else None
+        if line is None or int(line.split(b",", 3)[2]) >= yyyymmdd:
+            hi = mid
+        else:
+            lo = mid + 1
+    return nextLineStart(fileIn, lo, dataStart)
+
+# Byte offsets of the first line of the year and of the first line after it, years have offsets of their first rows
+def yearBounds(years, year, dataStart, size):
+    lo, hi = dataStart, size
+    for otherYear, offset in years.items():
+        if int(otherYear) <= year: lo = max(lo, offset)
+        else: hi = min(hi, offset)
+    return lo, hi
+
+# Byte offset of the line before the line at given offset, or the offset itself if it's the first line
+def previousLineStart(fileIn, offset, dataStart):
+    start = offset
+    while start > dataStart:
+        chunkStart = max(dataStart, start - 4096)
+        fileIn.seek(chunkStart)
+        chunk = fileIn.read(offset - 1 - chunkStart) # skip newline ending previous line
+        newline = chunk.rfind(b"\n")
+        if newline >= 0:
+            return chunkStart + newline + 1
+        start = chunkStart
+    return dataStart
+
+# Read only rows of given date ranges from Stooq text file (see DataNeeds), returns ticker, date ordinals and close prices
+# Byte offsets of years from manifest narrow down the search to one year, rows of every range are read and parsed at once
+def readStooqRanges(filePath, ranges, years=None):
+    ticker, dates, closes = None, array('i'), array('d')
+    with open(filePath, "rb") as fileIn:
+        size = os.fstat(fileIn.fileno()).st_size
+        header = fileIn.readline()
+        dataStart = len(header) if header.startswith(b"<") else 0 # skip the header that starts with "<TICKER>"
+        for fromOrdinal, toOrdinal in ranges:
+            if fromOrdinal is None:
+                offset = dataStart
+            else:
+                lo, hi = yearBounds(years, datetime.date.fromordinal(fromOrdinal).year, dataStart, size) if years else (dataStart, size)
+                offset = previousLineStart(fileIn, seekDate(fileIn, ordinalToStooq(fromOrdinal), lo, hi), dataStart)
+            end = size if toOrdinal is None else seekDate(fileIn, ordinalToStooq(toOrdinal + 1), offset, size)
+            if end <= offset: continue
+            fileIn.seek(offset)
+            rangeTicker, rangeDates, values = parseStooqBytes(fileIn.read(end - offset), ("close",), filePath, None, offset)
+            first = bisect.bisect_right(rangeDates, dates[-1]) if dates else 0 # skip days already read as part of previous range
+            dates.extend(rangeDates[first:])
+            closes.extend(values["close"][first:])
+            ticker = ticker or rangeTicker
+    return ticker, dates, closes
+
+# Ticker name derived from file name, used when file has no rows to take it from
+def tickerFromFileName(fileName):
+    return os.path.splitext(fileName)[0].upper()
+
+# Index one Stooq text file for manifest: ticker, first and last date, number of rows and byte offset of first row of every year.
+# Raises StooqFormatError for row without ticker, period and date or when the first or the last date can't be parsed
+def indexStooqFile(filePath):
+    ticker, first, last, rows, years = None, None, None, 0, {}
+    with open(filePath, "rb") as fileIn:
+        offset = 0
+        for lineNumber, line in enumerate(fileIn, 1):
+            if line[0] != ord('<'): # skip the header that starts with "<TICKER>"
+                fields = line.split(b",", 3)
+                if len(fields) < 3:
+                    raise StooqFormatError(filePath, f"line {lineNumber}", "expected ticker, period and date")
+                ticker, period, sdate = fields[:3]
+                if sdate[:4] not in years:
+                    years[sdate[:4]] = offset
+                if first is None: first = sdate
+                last = sdate
+                rows += 1
+            offset += len(line)
+    try:
+        first, last = (stooqToOrdinal(first), stooqToOrdinal(last)) if first else (None, None)
+    except ValueError:
+        raise StooqFormatError(filePath, "first or last row", f"bad date {first.decode(errors='replace')} or {last.decode(errors='replace')}")
+    return {"ticker": ticker.decode() if ticker else None, "rows": rows, "first": first, "last": last,
+            "years": {year.decode(): offset for year, offset in years.items()}}
+
+# Manifest of text database is stored next to its folder, for example daily.manifest.json for daily
+def manifestPath(folder):
+    return os.path.abspath(folder) + ".manifest.json"
+
+# Load manifest of text database and refresh it: every file is checked by mtime and size, only new and changed files are read.
+# Without refresh manifest is used as is, so nothing but the manifest itself is read
+def loadManifest(folder, refresh=True, progress=None):
+    entries = {}
+    try:
+        with open(manifestPath(folder), "r") as fileIn:
+            manifest = json.load(fileIn)
+        if manifest.get("version") == MANIFEST_VERSION:
+            entries = {entry["path"]: entry for entry in manifest["tickers"]}
+    except (OSError, ValueError):
+        pass # missing or broken manifest is created again
+    if not refresh and entries:
+        return list(entries.values())
+
+    files, changed = [], False
+    for path, subdirs, fileNames in os.walk(folder):
+        files.extend(os.path.join(path, fileName) for fileName in fileNames)
+    refreshed = []
+    for fileCounter, filePath in enumerate(files, 1):
+        if progress: progress(fileCounter, len(files))
+        stat = os.stat(filePath)
+        relPath = os.path.relpath(filePath, folder)
+        entry = entries.get(relPath)
+        if not entry or entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            changed = True
+            try:
+                entry = {"path": relPath, "mtime": stat.st_mtime_ns, "size": stat.st_size, **indexStooqFile(filePath)}
+            except (OSError, ValueError) as error: # unreadable file or malformed row, left out of manifest
+                print(f"Skipping {filePath}: {getattr(error, 'problem', error)}")
+                continue
+            entry["ticker"] = entry["ticker"] or tickerFromFileName(os.path.basename(filePath))
+        refreshed.append(entry)
+    if changed or len(refreshed) != len(entries):
+        try:
+            with open(manifestPath(folder) + ".tmp", "w") as fileOut:
+                json.dump({"version": MANIFEST_VERSION, "tickers": refreshed}, fileOut)
+            os.replace(manifestPath(folder) + ".tmp", manifestPath(folder))
+        except OSError as e:
+            print(f"Can't save manifest {manifestPath(folder)} - {str(e)}")
+    return refreshed
+
+# Stooq database unpacked into folder tree, every file is a stock or ETF, files are listed in manifest
+class StooqFolder():
+    def __init__(self, folder, refresh=True):
+        self.folder = folder
+        self.refresh = refresh
+
+    def entries(self, progress=None):
+        return loadManifest(self.folder, self.refresh, progress)
+
+    # prices of ticker, only rows of the date ranges if they are given
+    def series(self, entry, ranges=None):
+        if ranges is None or ranges == [(None, None)]:
+            ticker, dates, columns = parseStooqFile(os.path.join(self.folder, entry["path"]), ("close",))
+            return ticker or entry["ticker"], dates, columns["close"]
+        ticker, dates, closes = readStooqRanges(os.path.join(self.folder, entry["path"]), ranges, entry.get("years"))
+        return ticker or entry["ticker"], dates, closes
+
+    # all columns of ticker
+    def parse(self, entry):
+        return parseStooqFile(os.path.join(self.folder, entry["path"]))
+
+# Database member is included when there is no filter or the filter names its ticker (like "FB.US") or a folder on its path
+# (like "nyse etfs" or "nasdaq stocks/1")
+def included(path, ticker, include):
+    if not include: return True
+    path = "/" + path.replace(os.sep, "/").lower()
+    return any(pattern.lower() == (ticker or "").lower() or "/" + pattern.strip("/").lower() + "/" in path for pattern in include)
+
+# Index of Stooq text file in memory for manifest: ticker, first and last date and number of rows, only the first and the last
+# row are parsed
+def indexStooqBytes(data):
+    body = data.rstrip(b"\r\n")
+    if body.startswith(b"<"): # skip the header that starts with "<TICKER>"
+        body = body[body.find(b"\n") + 1:] if b"\n" in body else b""
+    if not body:
+        return {"ticker": None, "rows": 0, "first": None, "last": None}
+    ticker, period, first = body[:body.find(b"\n")].split(b",", 3)[:3] if b"\n" in body else body.split(b",", 3)[:3]
+    last = body[body.rfind(b"\n") + 1:].split(b",", 3)[2]
+    return {"ticker": ticker.decode(), "rows": body.count(b"\n") + 1, "first": stooqToOrdinal(first), "last": stooqToOrdinal(last)}
+
+# Stooq database as downloaded zip file, members are decompressed in memory instead of being extracted to disk. Members
+# are listed in manifest next to the zip like files of folder, a member is indexed again only when its CRC or size changes.
+# Members of entries given to prefetch() are decompressed ahead in threads while series() parses the previous ones
+class StooqZip():
+    def __init__(self, zipPath, refresh=True, include=None, threads=4):
+        self.zipPath, self.refresh, self.include, self.threads = zipPath, refresh, include, threads
+        self.local, self.pool, self.fetched, self.ahead = threading.local(), None, {}, iter(())
+
+    # only settings are pickled, worker process opens the zip again
+    def __getstate__(self):
+        return {"zipPath": self.zipPath, "refresh": self.refresh, "include": self.include, "threads": self.threads}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    # decompressed member, every thread reads through its own handle of the zip
+    def read(self, path):
+        if not hasattr(self.local, "zipFile"):
+            self.local.zipFile = zipfile.ZipFile(self.zipPath)
+        try:
+            return self.local.zipFile.read(path)
+        except KeyError:
+            raise StooqFormatError(self.zipPath, path, "member not found, zip changed since it was indexed")
+        except (zipfile.BadZipFile, zlib.error) as error:
+            raise StooqFormatError(self.zipPath, path, str(error))
+
+    def executor(self):
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        return self.pool
+
+    # entry of member for manifest, None for broken member that is skipped until the zip changes
+    def index(self, info):
+        try:
+            entry = {"path": info.filename, "mtime": int(datetime.datetime(*info.date_time).timestamp()) * 10**9,
+                     "size": info.file_size, "crc": info.CRC, **indexStooqBytes(self.read(info.filename))}
+        except ValueError as error: # broken member or malformed row
+            print(f"Skipping {info.filename} of {self.zipPath}: {getattr(error, 'problem', error)}")
+            return None
+        entry["ticker"] = entry["ticker"] or tickerFromFileName(os.path.basename(info.filename))
+        return entry
+
+    # included members of the zip, new and changed members are indexed in threads
+    def entries(self, progress=None):
+        known = {}
+        try:
+            with open(manifestPath(self.zipPath), "r") as fileIn:
+                manifest = json.load(fileIn)
+            if manifest.get("version") == MANIFEST_VERSION:
+                known = {entry["path"]: entry for entry in manifest["tickers"]}
+        except (OSError, ValueError):
+            pass # missing or broken manifest is created again
+
+        # list of members is read from the end of the zip without decompressing anything, so it's read even without refresh
+        with zipfile.ZipFile(self.zipPath) as zipFile:
+            members = [info for info in zipFile.infolist() if not info.is_dir()]
+        wanted = [info for info in members if included(info.filename, tickerFromFileName(os.path.basename(info.filename)), self.include)]
+        def stale(info):
+            entry = known.get(info.filename)
+            return entry is None or self.refresh and (entry["crc"] != info.CRC or entry["size"] != info.file_size)
+        stale = [info for info in wanted if stale(info)]
+        for fileCounter, (info, entry) in enumerate(zip(stale, self.executor().map(self.index, stale)), 1):
+            if progress: progress(fileCounter, len(stale))
+            if entry: known[entry["path"]] = entry
+            else: known.pop(info.filename, None)
+        names = {info.filename for info in members}
+        if stale or any(path not in names for path in known): # members excluded by filter stay indexed for next runs
+            known = {path: entry for path, entry in known.items() if path in names}
+            try:
+                with open(manifestPath(self.zipPath) + ".tmp", "w") as fileOut:
+                    json.dump({"version": MANIFEST_VERSION, "tickers": list(known.values())}, fileOut)
+                os.replace(manifestPath(self.zipPath) + ".tmp", manifestPath(self.zipPath))
+            except OSError as e:
+                print(f"Can't save manifest {manifestPath(self.zipPath)} - {str(e)}")
+        return [known[info.filename] for info in wanted if info.filename in known]
+
+    # start decompressing members of entries in threads, series() has to ask for them in the same order
+    def prefetch(self, entries):
+        self.fetched, self.ahead = {}, iter(entries)
+        self.fill()
+
+    # keep a few members per thread decompressed or being decompressed ahead
+    def fill(self):
+        while len(self.fetched) < 4 * self.threads:
+            entry = next(self.ahead, None)
+            if entry is None: return
+            self.fetched[entry["path"]] = self.executor().submit(self.read, entry["path"])
+
+    def member(self, entry):
+        future = self.fetched.pop(entry["path"], None)
+        if future is None:
+            return self.read(entry["path"])
+        self.fill()
+        return future.result()
+
+    # prices of ticker, only rows of the date ranges if they are given, the whole member is decompressed anyway
+    def series(self, entry, ranges=None):
+        ticker, dates, columns = parseStooqBytes(self.member(entry), ("close",), f"{self.zipPath}/{entry['path']}")
+        dates, closes = selectRanges(dates, columns["close"], ranges)
+        return ticker or entry["ticker"], dates, closes
+
+    # all columns of ticker
+    def parse(self, entry):
+        return parseStooqBytes(self.member(entry), COLUMNS, f"{self.zipPath}/{entry['path']}")
+
+# Rows of parsed prices (typed arrays or memory views) within the date ranges (see DataNeeds)
+def selectRanges(dates, closes, ranges):
+    if ranges is None or ranges == [(None, None)]:
+        return dates, closes
+    slices = []
+    for fromOrdinal, toOrdinal in ranges:
+        first = 0 if fromOrdinal is None else max(0, bisect.bisect_left(dates, fromOrdinal) - 1) # include the day before range
+        last = len(dates) if toOrdinal is None else bisect.bisect_right(dates, toOrdinal)
+        if slices and first < slices[-1][1]: # overlaps with previous range
+            first = slices[-1][1]
+        if first < last:
+            slices.append((first, last))
+    if len(slices) == 1:
+        first, last = slices[0]
+        return dates[first:last], closes[first:last] # zero copy for memory views
+    rangeDates, rangeCloses = array('i'), array('d')
+    for first, last in slices:
+        rangeDates.frombytes(dates[first:last].tobytes())
+        rangeCloses.frombytes(closes[first:last].tobytes())
+    return rangeDates, rangeCloses
+
+# Stooq database compiled into columnar binary cache: one file per column with rows of all tickers concatenated,
+# every ticker is a contiguous slice described in index.json, columns are memory-mapped on first access
+class StooqCache():
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        with open(os.path.join(cacheDir, CACHE_INDEX), "r") as fileIn:
+            self.index = json.load(fileIn)
+        if self.index.get("version") != CACHE_VERSION or self.index.get("byteorder") != sys.byteorder:
+            raise ValueError(f"Incompatible cache in {cacheDir}, compile it again")
+        self.views = None
+
+    # don't pickle memory maps, they are re-opened by the process that reads the cache
+    def __getstate__(self):
+        return {"cacheDir": self.cacheDir, "index": self.index, "views": None}
+
+    def column(self, name):
+        if self.views is None:
+            self.views = {"date": mapColumn(self.cacheDir, "date", 'i')}
+            self.views.update({column: mapColumn(self.cacheDir, column, 'd') for column in COLUMNS})
+        return self.views[name]
+
+    def entries(self):
+        return self.index["tickers"]
+
+    # prices of ticker, only rows of the date ranges if they are given (see DataNeeds)
+    def series(self, entry, ranges=None):
+        offset, rows = entry["offset"], entry["rows"]
+        dates, closes = selectRanges(self.column("date")[offset:offset+rows], self.column("close")[offset:offset+rows], ranges)
+        return entry["ticker"], dates, closes
+
+    def ohlcv(self, entry):
+        offset, rows = entry["offset"], entry["rows"]
+        return {column: self.column(column)[offset:offset+rows] for column in ("date",) + COLUMNS}
+
+    # unmap column files, so they can be replaced even on Windows. Slices of columns must be released before
+    def close(self):
+        views, self.views = self.views or {}, None
+        for view in views.values():
+            mapped = view.obj
+            view.release()
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+def columnPath(cacheDir, name):
+    return os.path.join(cacheDir, name + ".bin")
+
+# Memory-map column file as typed read-only view, empty columns can't be mapped so plain empty array is used instead
+def mapColumn(cacheDir, name, typecode):
+    with open(columnPath(cacheDir, name), "rb") as fileIn:
+        if os.fstat(fileIn.fileno()).st_size == 0:
+            return memoryview(array(typecode))
+        return memoryview(mmap.mmap(fileIn.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+def isCache(path):
+    return os.path.isfile(os.path.join(path, CACHE_INDEX))
+
+def isZip(path):
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
+
+# Open Stooq database as compiled cache, downloaded zip (only members matching include filter) or folder with text files
+def openSource(path, refresh=True, include=None, threads=4):
+    if isZip(path):
+        return StooqZip(path, refresh, include, threads)
+    return StooqCache(path) if isCache(path) else StooqFolder(path, refresh)
+
+# Compile Stooq text database (folder or zip) into columnar cache, only tickers whose source file mtime/size changed are
+# parsed again
+def compileDatabase(folderIn, cacheDir, progress=None):
+    os.makedirs(cacheDir, exist_ok=True)
+    old, oldEntries = None, {}
+    if isCache(cacheDir):
+        try:
+            old = StooqCache(cacheDir)
+            oldEntries = {entry["path"]: entry for entry in old.entries()}
+        except (ValueError, KeyError):
+            old = None # incompatible cache, rebuild everything
+
+    outputs = {"date": open(columnPath(cacheDir, "date") + ".tmp", "wb")}
+    outputs.update({column: open(columnPath(cacheDir, column) + ".tmp", "wb") for column in COLUMNS})
+    entries, offset, parsed, reused = [], 0, 0, 0
+    try:
+        source = StooqZip(folderIn) if isZip(folderIn) else StooqFolder(folderIn)
+        sourceEntries = source.entries(progress)
+        def unchanged(entry):
+            prev = oldEntries.get(entry["path"])
+            return prev is not None and prev["mtime"] == entry["mtime"] and prev["size"] == entry["size"]
+        if hasattr(source, "prefetch"):
+            source.prefetch([entry for entry in sourceEntries if not unchanged(entry)])
+        for fileCounter, entry in enumerate(sourceEntries, 1):
+            if progress: progress(fileCounter, len(sourceEntries))
+            entry = {name: value for name, value in entry.items() if name != "years"} # byte offsets make no sense in cache
+            entry["offset"] = offset
+            if unchanged(entry):
+                data = old.ohlcv(oldEntries[entry["path"]]) # unchanged since last compile, copy its rows as is
+                reused += 1
+            else:
+                try:
+                    ticker, dates, data = source.parse(entry)
+                except (OSError, StooqFormatError) as error: # left out of cache like a scan skips it
+                    print(f"Skipping {entry['path']}: {getattr(error, 'problem', error)}")
+                    continue
+                data["date"] = dates
+                parsed += 1
+            for name, fileOut in outputs.items():
+                fileOut.write(data[name])
+            del data # rows of old cache are slices of its memory maps
+            offset += entry["rows"]
+            entries.append(entry)
+    except BaseException:
+        for name, fileOut in outputs.items(): # failed compile leaves the old cache as it was
+            fileOut.close()
+            os.remove(columnPath(cacheDir, name) + ".tmp")
+        raise
+    finally:
+        for fileOut in outputs.values():
+            fileOut.close()
+    if old:
+        old.close() # memory mapped files can't be replaced on Windows
+
+    for name in outputs:
+        os.replace(columnPath(cacheDir, name) + ".tmp", columnPath(cacheDir, name))
+    with open(os.path.join(cacheDir, CACHE_INDEX), "w") as fileOut:
+        json.dump({"version": CACHE_VERSION, "byteorder": sys.byteorder, "source": os.path.abspath(folderIn), "tickers": entries}, fileOut)
+    return parsed, reused